@@ -0,0 +1,63 @@
+import time
+from typing import Dict, List, Optional
+
+# Only these fields are kept, the raw mod_assign_get_assignments payload carries full intros
+FIELDS = ("id", "cmid", "course", "name", "duedate")
+
+
+class AssignmentIndex:
+    """
+    Two-way cmid <-> instance id <-> course lookup for the user's assignments.
+    Built from a single mod_assign_get_assignments response.
+    """
+
+    def __init__(self, assignments: List[dict], fetched_at: Optional[float] = None):
+        self.assignments = assignments
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.by_cmid: Dict[int, dict] = {}
+        self.by_instance: Dict[int, dict] = {}
+        self.by_course: Dict[int, List[dict]] = {}
+        for a in assignments:
+            self.by_cmid[a["cmid"]] = a
+            self.by_instance[a["id"]] = a
+            self.by_course.setdefault(a["course"], []).append(a)
+
+    @classmethod
+    def from_response(cls, data: dict) -> "AssignmentIndex":
+        assignments = []
+        for course in data.get("courses") or []:
+            for a in course.get("assignments") or []:
+                if a.get("id") is None or a.get("cmid") is None:
+                    continue
+                entry = {k: a.get(k) for k in FIELDS}
+                entry["course"] = entry["course"] or course.get("id")
+                assignments.append(entry)
+        return cls(assignments)
+
+    def to_json(self) -> dict:
+        return {"fetched_at": self.fetched_at, "assignments": self.assignments}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "AssignmentIndex":
+        return cls(data["assignments"], data["fetched_at"])
+
+    def resolve(self, any_id) -> Optional[dict]:
+        """
+        Finds an assignment by course-module ID or instance ID.
+        CMIDs win, that's what the Moodle URL (view.php?id=...) shows.
+        """
+        try:
+            key = int(any_id)
+        except (TypeError, ValueError):
+            return None
+        return self.by_cmid.get(key) or self.by_instance.get(key)
+
+    def cmid_for_instance(self, instance_id) -> Optional[int]:
+        try:
+            entry = self.by_instance.get(int(instance_id))
+        except (TypeError, ValueError):
+            return None
+        return entry["cmid"] if entry else None
+
+    def __len__(self) -> int:
+        return len(self.assignments)
@@ -0,0 +1,562 @@
+"""
+Benchmarks SmartSubmit against the local fake Moodle (fake_moodle.py), no real LMS involved.
+
+    python benchmark.py                          # all scenarios, default sizes
+    python benchmark.py deadlines submit --latency 0.1 --events 2000
+    python benchmark.py files --files 100000 --output bench_output.txt
+
+Every scenario reports p50/p95/p99 latency and throughput, so runs can be compared
+before and after a change. The resilience and tenants scenarios are correctness checks
+against the same fake LMS: a failed check shows err=1 and makes the run exit with status 1.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import tempfile
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, List, Optional
+
+import uvicorn
+
+from fake_moodle import FAKE_TOKEN, FAKE_USER_ID, FakeMoodle, FakeMoodleConfig, create_app
+
+SCENARIOS = ["deadlines", "submit", "files", "webhook", "resilience", "tenants"]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Report:
+    """Collects one result line per benchmark and prints them as a table."""
+
+    HEADER = f"{'benchmark':<28} {'n':>6} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9}  extra"
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.failed_checks: List[str] = []
+
+    def add(self, name: str, latencies: List[float], errors: int, wall: float, extra: str = ""):
+        values = sorted(latencies)
+        line = (
+            f"{name:<28} {len(values):>6} {errors:>4} "
+            f"{percentile(values, 50) * 1e3:>9.2f} {percentile(values, 95) * 1e3:>9.2f} "
+            f"{percentile(values, 99) * 1e3:>9.2f} {len(values) / max(wall, 1e-9):>9.1f}  {extra}"
+        )
+        self.lines.append(line)
+        print(line, flush=True)
+
+    def text(self) -> str:
+        return "\n".join([self.HEADER, *self.lines]) + "\n"
+
+
+async def measure(
+    report: Report,
+    name: str,
+    fn: Callable[[int], Awaitable[object]],
+    iterations: int,
+    concurrency: int = 1,
+    extra: Optional[Callable[[float], str]] = None,
+):
+    """Runs fn(0..iterations-1), at most `concurrency` at once, and records each call's latency."""
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await fn(i)
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"  {name} #{i} failed: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(iterations)))
+    wall = time.perf_counter() - started
+    report.add(name, latencies, errors, wall, extra(wall) if extra else "")
+
+
+def expect(result: str, *markers: str) -> str:
+    """Tools report failures as text, turn unexpected answers into benchmark errors."""
+    if not any(m in result for m in markers):
+        raise RuntimeError(result[:200])
+    return result
+
+
+def ensure(ok: bool, message: str):
+    if not ok:
+        raise RuntimeError(message)
+
+
+async def check(report: Report, name: str, fn: Callable[[], Awaitable[None]]):
+    """Runs one correctness check as a single-iteration benchmark, remembering it if it fails."""
+    async def once(i: int):
+        try:
+            await fn()
+        except Exception:
+            report.failed_checks.append(name)
+            raise
+
+    await measure(report, f"check {name}", once, 1)
+
+
+class FakeMoodleServer:
+    """Serves the fake LMS over real HTTP (uvicorn in a thread) so connection pooling is exercised."""
+
+    def __init__(self, fake: FakeMoodle):
+        self.fake = fake
+        self.server = uvicorn.Server(uvicorn.Config(create_app(fake), host="127.0.0.1", port=0, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self) -> "FakeMoodleServer":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    @property
+    def url(self) -> str:
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/webservice/rest/server.php"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+# --- Scenarios ---
+
+async def bench_deadlines(report: Report, args):
+    import tools
+    import deadline_sync
+
+    await measure(report, "deadlines live (first)", lambda i: tools.check_deadlines(fresh=True), 1)
+    await measure(
+        report, "deadlines live", lambda i: tools.check_deadlines(fresh=True), args.iterations,
+        extra=lambda wall: f"{args.events} events",
+    )
+    await measure(
+        report, "deadlines live limit=5", lambda i: tools.check_deadlines(limit=5, fresh=True), args.iterations,
+    )
+    await measure(
+        report, "deadlines live filtered", lambda i: tools.check_deadlines(f"lab {i % 50 + 1:02d}", fresh=True),
+        args.iterations, args.concurrency,
+    )
+
+    engine = await deadline_sync.start_engine()
+    try:
+        await measure(report, "deadline sync full", lambda i: engine.sync_once(full=True), max(1, args.iterations // 5))
+        await measure(report, "deadline sync incremental", lambda i: engine.sync_once(), max(1, args.iterations // 5))
+        await measure(
+            report, "deadlines snapshot", lambda i: tools.check_deadlines(f"lab {i % 50 + 1:02d}"),
+            args.iterations * 10, args.concurrency,
+        )
+    finally:
+        await deadline_sync.stop_engine()
+
+
+async def bench_submit(report: Report, args, fake: FakeMoodle, workdir: str):
+    import tools
+
+    size = int(args.file_size_mb * 1024 * 1024)
+    path = os.path.join(workdir, f"Lab_Report_{args.file_size_mb:g}MB.pdf")
+    with open(path, "wb") as f:
+        chunk = os.urandom(1024 * 1024)
+        for offset in range(0, size, len(chunk)):
+            f.write(chunk[: size - offset])
+
+    cmids = [a["cmid"] for a in fake.assignments]
+    iterations = min(args.iterations, len(cmids))
+    throughput = lambda wall: f"{iterations * size / wall / 1048576:.1f} MB/s"
+    await measure(
+        report, f"submit {args.file_size_mb:g}MB",
+        lambda i: _submit(tools, cmids[i], path), iterations, extra=throughput,
+    )
+    await measure(
+        report, f"submit {args.file_size_mb:g}MB identical",
+        lambda i: _submit(tools, cmids[i], path, "ALREADY SUBMITTED"), iterations,
+    )
+
+    items = [{"assignment_id": str(cmid), "file_path": path} for cmid in cmids[iterations:iterations * 2]]
+    if items:
+        async def batch(i):
+            results = await tools.submit_batch_to_lms(items, args.concurrency)
+            failed = [r for r in results if not r.ok]
+            if failed:
+                raise RuntimeError(failed[0].message)
+
+        await measure(
+            report, f"submit_batch x{len(items)}", batch, 1,
+            extra=lambda wall: f"{len(items) * size / wall / 1048576:.1f} MB/s",
+        )
+
+
+async def _submit(tools, cmid: int, path: str, marker: str = "SUCCESS"):
+    return expect(await tools.submit_to_lms(str(cmid), path), marker)
+
+
+def make_file_tree(root: str, count: int, seed: int = 1) -> None:
+    """Creates `count` empty lab files spread over course/week folders (100 per folder)."""
+    rng = random.Random(seed)
+    courses = ["Big_Data_Analytics", "CompilerConstruction", "OS", "Data-Structures", "ML", "Networks"]
+    kinds = ["LAB", "Assignment", "Report", "Quiz", "Project"]
+    exts = [".pdf", ".docx", ".zip", ".xlsx", ".txt", ".png"]
+    per_dir = 100
+    for n in range(count):
+        folder = os.path.join(root, courses[n % len(courses)], f"week_{n // per_dir:04d}")
+        if n % per_dir == 0 or not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        name = f"{rng.choice(kinds)}_{rng.randint(1, 15):02d}_{courses[n % len(courses)]}_{n}{rng.choice(exts)}"
+        open(os.path.join(folder, name), "wb").close()
+
+
+async def bench_files(report: Report, args, workdir: str):
+    import tools
+
+    root = os.path.join(workdir, "labs")
+    started = time.perf_counter()
+    make_file_tree(root, args.files)
+    print(f"  created {args.files} files in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    queries = ["bda lab 3", "compiler construction report", "os quiz 12", "networks project", "reprot", "ml 07"]
+    await measure(
+        report, f"files cold index ({args.files})", lambda i: tools.list_lab_files(root, "lab 1"), 1,
+    )
+    await measure(
+        report, "files search (warm)",
+        lambda i: tools.list_lab_files(root, queries[i % len(queries)]), args.iterations * 5,
+    )
+    await measure(report, "files list all (warm)", lambda i: tools.list_lab_files(root), args.iterations)
+
+    index = tools.get_file_index()
+    await measure(
+        report, "files rescan (unchanged)", lambda i: asyncio.to_thread(index.refresh, root, 0), max(1, args.iterations // 5),
+    )
+
+
+async def bench_webhook(report: Report, args):
+    import httpx
+    import webhook
+    from jobs import LogSender
+
+    sender = LogSender()
+    webhook.job_queue = None
+    async with webhook.lifespan(webhook.app):
+        webhook.job_queue.sender = sender
+        transport = httpx.ASGITransport(app=webhook.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://webhook") as http:
+            bodies = ["status", "deadline lab 1", "deadline lab 2", "status"]
+            total = args.iterations * 10
+
+            async def post(i: int):
+                resp = await http.post("/whatsapp", data={
+                    "From": f"whatsapp:+1555{i % 20:07d}", "Body": bodies[i % len(bodies)], "MessageSid": f"SM{time.time_ns()}{i}",
+                })
+                resp.raise_for_status()
+
+            started = time.perf_counter()
+            await measure(report, "webhook ack", post, total, args.concurrency * 4)
+            # Jobs finish after Twilio got its answer, wait for every outbound reply
+            while len(sender.sent) < total and time.perf_counter() - started < 120:
+                await asyncio.sleep(0.01)
+            wall = time.perf_counter() - started
+            report.lines.append(
+                f"{'webhook end-to-end':<28} {len(sender.sent):>6} {total - len(sender.sent):>4} "
+                f"{'':>9} {'':>9} {'':>9} {len(sender.sent) / wall:>9.1f}  replies delivered in {wall:.2f}s"
+            )
+            print(report.lines[-1], flush=True)
+
+
+@contextmanager
+def fresh_policy(url: str):
+    """A new HostPolicy (breaker, latencies, hedge budget) for the LMS host inside the block."""
+    import httpx
+    import resilience
+    import state
+
+    policies = state.keep("resilience.hosts", dict)
+    host = httpx.URL(url).host
+    saved = policies.pop(host, None)
+    try:
+        yield resilience.for_host(url)
+    finally:
+        policies.pop(host, None)
+        if saved is not None:
+            policies[host] = saved
+
+
+@contextmanager
+def budget(wsfunction: str, seconds: float):
+    """Temporarily shortens a wsfunction's latency budget, so timeouts happen within the check."""
+    import moodle_client
+
+    saved = moodle_client.WSFUNCTION_TIMEOUTS.get(wsfunction)
+    moodle_client.WSFUNCTION_TIMEOUTS[wsfunction] = seconds
+    try:
+        yield
+    finally:
+        if saved is None:
+            moodle_client.WSFUNCTION_TIMEOUTS.pop(wsfunction, None)
+        else:
+            moodle_client.WSFUNCTION_TIMEOUTS[wsfunction] = saved
+
+
+async def bench_resilience(report: Report, fake: FakeMoodle, workdir: str):
+    import moodle_client
+    import resilience
+
+    client = moodle_client.get_client()
+
+    async def breaker_transitions():
+        with fresh_policy(client.url) as policy:
+            breaker = policy.breaker
+            breaker.open_seconds = 0.5
+            opened = resilience.CIRCUIT_TRANSITIONS.value(state="open")
+            half_open = resilience.CIRCUIT_TRANSITIONS.value(state="half_open")
+            # Every request fails until the breaker opens (reads retry 5xx, so it takes a couple of calls)
+            fake.faults[:] = ["http"] * breaker.failure_threshold
+            for _ in range(breaker.failure_threshold):
+                if breaker.state == "open":
+                    break
+                try:
+                    await client.call("core_webservice_get_site_info")
+                except Exception:
+                    pass
+            fake.faults.clear()
+            ensure(breaker.state == "open", f"breaker is {breaker.state} after {breaker.failure_threshold} failures")
+
+            sent = fake.requests
+            try:
+                await client.call("core_webservice_get_site_info")
+                ensure(False, "open breaker let a call through")
+            except resilience.CircuitOpenError:
+                pass
+            ensure(fake.requests == sent, "open breaker still sent a request")
+
+            # A failing probe re-opens it, a successful one closes it
+            await asyncio.sleep(breaker.open_seconds)
+            fake.faults[:] = ["http"]
+            try:
+                await client.call("core_webservice_get_site_info")
+            except Exception:
+                pass
+            fake.faults.clear()
+            ensure(breaker.state == "open", f"breaker is {breaker.state} after a failed probe")
+            await asyncio.sleep(breaker.open_seconds)
+            await client.call("core_webservice_get_site_info")
+            ensure(breaker.state == "closed", f"breaker is {breaker.state} after a successful probe")
+            ensure(resilience.CIRCUIT_TRANSITIONS.value(state="open") - opened == 2, "expected closed -> open twice")
+            ensure(resilience.CIRCUIT_TRANSITIONS.value(state="half_open") - half_open == 2, "expected two probes")
+
+    async def writes_sent_once():
+        path = os.path.join(workdir, "write_check.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF write check")
+        wsfunction = "mod_assign_submit_for_grading"
+        fake.config.hang_seconds, hang_seconds = 2.0, fake.config.hang_seconds
+        try:
+            with fresh_policy(client.url), budget(wsfunction, 0.5):
+                # 503: the LMS got the request. hang: it may have, the client gives up first.
+                for fault in ("http", "moodle", "hang"):
+                    sent = fake.calls.get(wsfunction, 0)
+                    fake.faults[:] = [fault]
+                    try:
+                        await client.call(wsfunction, assignmentid=fake.assignments[0]["id"])
+                        ensure(False, f"{wsfunction} succeeded despite a {fault} fault")
+                    except RuntimeError:
+                        raise
+                    except Exception:
+                        pass
+                    ensure(fake.calls.get(wsfunction, 0) - sent == 1, f"{wsfunction} was repeated after a {fault} fault")
+                sent = fake.calls.get("upload", 0)
+                fake.faults[:] = ["http"]
+                try:
+                    await client.upload(path)
+                    ensure(False, "upload succeeded despite a 503")
+                except RuntimeError:
+                    raise
+                except Exception:
+                    pass
+                ensure(fake.calls.get("upload", 0) - sent == 1, "upload was repeated after a 503")
+        finally:
+            fake.faults.clear()
+            fake.config.hang_seconds = hang_seconds
+
+    async def slow_reads_hedge_cap():
+        wsfunction = "core_enrol_get_users_courses"
+        reads = 40
+        with fresh_policy(client.url) as policy:
+            # Learn the normal p95, then make the LMS 10x slower: reads must all succeed without
+            # retries or breaker failures, and hedges must stay within HEDGE_MAX_RATIO of all reads
+            for _ in range(resilience.LATENCY_MIN_SAMPLES):
+                await client.call(wsfunction, userid=FAKE_USER_ID)
+            latency = fake.config.latency
+            fake.config.latency = latency * 10
+            retries = resilience.RETRIES.value(wsfunction=wsfunction)
+            sent = fake.calls.get(wsfunction, 0)
+            try:
+                # In waves that fit the connection pool, so hedges reach the LMS instead of queueing
+                for _ in range(0, reads, 10):
+                    await asyncio.gather(*(client.call(wsfunction, userid=FAKE_USER_ID) for _ in range(10)))
+            finally:
+                fake.config.latency = latency
+            hedges = fake.calls.get(wsfunction, 0) - sent - reads
+            allowed = int(resilience.HEDGE_MAX_RATIO * (resilience.LATENCY_MIN_SAMPLES + reads))
+            ensure(hedges <= allowed, f"{hedges} hedged requests for {reads} slow reads, at most {allowed} allowed")
+            ensure(resilience.RETRIES.value(wsfunction=wsfunction) == retries, "slow reads were retried")
+            ensure(policy.breaker.state == "closed", f"slow reads left the breaker {policy.breaker.state}")
+
+    await check(report, "breaker transitions", breaker_transitions)
+    await check(report, "writes sent once", writes_sent_once)
+    await check(report, "slow reads / hedge cap", slow_reads_hedge_cap)
+
+
+async def bench_tenants(report: Report, fake: FakeMoodle, workdir: str):
+    import json
+    import moodle_client
+    import tenants
+    import tools
+    import webhook
+
+    accounts = {"+15550000001": ("tenant-token-a", 501), "+15550000002": ("tenant-token-b", 502)}
+    config = {}
+    for number, (token, userid) in accounts.items():
+        fake.add_user(token, userid)
+        lab = os.path.join(workdir, "tenants", number.lstrip("+"))
+        os.makedirs(lab, exist_ok=True)
+        open(os.path.join(lab, "Lab_1.pdf"), "wb").close()
+        config[number] = {"token": token, "lab_directory": lab}
+    path = os.path.join(workdir, "tenants.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    registry = tenants.TenantRegistry(path)
+
+    async def isolation():
+        started = {}
+        for number, (token, userid) in accounts.items():
+            tenant = await registry.resolve(f"whatsapp:{number}")
+            sent = fake.token_calls.get(token, 0)
+            info = await registry.run(tenant, lambda: tools.get_site_info(moodle_client.get_client()))
+            ensure(info["userid"] == userid, f"{number} got user {info['userid']}, expected {userid}")
+            ensure(fake.token_calls.get(token, 0) > sent, f"{number} did not call the LMS with its own token")
+            started[number] = tenant
+        a, b = started.values()
+        ensure(a.client is not b.client and a.client.token != b.client.token, "tenants share a Moodle client")
+        for tenant, other in ((a, b), (b, a)):
+            ensure(
+                tenant.metadata_cache.get(tools._cache_key(other.client, "site_info")) is None,
+                f"{tenant.number}'s cache holds {other.number}'s site info",
+            )
+            ensure(
+                tools.metadata_cache.get(tools._cache_key(tenant.client, "site_info")) is None,
+                f"{tenant.number}'s site info leaked into the shared cache",
+            )
+
+    async def lab_confinement():
+        a, b = [await registry.resolve(f"whatsapp:{number}") for number in accounts]
+        other = os.path.join("..", os.path.basename(b.lab_directory), "Lab_1.pdf")
+        for name in (other, path, os.path.join(b.lab_directory, "Lab_1.pdf"), "."):
+            ensure(await asyncio.to_thread(webhook.confine_path, a.lab_directory, name) is None, f"{name!r} was allowed")
+        ensure(await asyncio.to_thread(webhook.confine_path, a.lab_directory, "Lab_1.pdf") is not None, "own file refused")
+
+    try:
+        await check(report, "tenant isolation", isolation)
+        await check(report, "tenant lab confinement", lab_confinement)
+    finally:
+        await registry.aclose()
+
+
+async def run(args, fake: FakeMoodle, workdir: str) -> Report:
+    import moodle_client
+
+    report = Report()
+    print(Report.HEADER, flush=True)
+    try:
+        if "deadlines" in args.scenarios:
+            await bench_deadlines(report, args)
+        if "submit" in args.scenarios:
+            fake.reset()
+            await bench_submit(report, args, fake, workdir)
+        if "files" in args.scenarios:
+            await bench_files(report, args, workdir)
+        if "webhook" in args.scenarios:
+            await bench_webhook(report, args)
+        if "resilience" in args.scenarios:
+            await bench_resilience(report, fake, workdir)
+        if "tenants" in args.scenarios:
+            await bench_tenants(report, fake, workdir)
+    finally:
+        await moodle_client.close_client()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartSubmit benchmarks against a fake Moodle.")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--courses", type=int, default=12)
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.03, help="seconds per fake LMS request")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--upload-throughput", type=float, default=0.0, help="bytes/s, 0 = unlimited")
+    parser.add_argument("--file-size-mb", type=float, default=20)
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--rate-limit", type=float, default=0, help="MOODLE_RATE_LIMIT for the run, 0 = off")
+    parser.add_argument("--output", help="also append the results table to this file (e.g. bench_output.txt)")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    fake = FakeMoodle(FakeMoodleConfig(
+        courses=args.courses, events=args.events, latency=args.latency, jitter=args.jitter,
+        failure_rate=args.failure_rate, upload_throughput=args.upload_throughput,
+    ))
+    with tempfile.TemporaryDirectory(prefix="smartsubmit-bench-") as workdir, FakeMoodleServer(fake) as server:
+        # Configure before the app modules read their settings, and keep local state out of the repo
+        os.environ.update({
+            "MOODLE_URL": server.url,
+            "MOODLE_TOKEN": FAKE_TOKEN,
+            "MOODLE_RATE_LIMIT": str(args.rate_limit),
+            "SMARTSUBMIT_CACHE_FILE": os.path.join(workdir, "cache.json"),
+            "FILE_INDEX_DB": os.path.join(workdir, "files.db"),
+            "DEADLINE_SNAPSHOT_FILE": os.path.join(workdir, "deadlines.json"),
+            "WHATSAPP_SENDER": "log",
+            "WHATSAPP_ALLOWED_NUMBER": "",
+        })
+        # Same INFO logging cost as production, written next to the other throwaway files
+        logging.basicConfig(
+            filename=os.path.join(workdir, "student_agent.log"),
+            level=logging.INFO,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+        report = asyncio.run(run(args, fake, workdir))
+        print(f"fake LMS served {fake.requests} requests: {fake.calls}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(sys.argv[1:])}\n{report.text()}\n")
+    if report.failed_checks:
+        print(f"FAILED checks: {', '.join(report.failed_checks)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Small LRU cache where every entry carries its own TTL.
+    - Bounded: the least recently used entry is evicted once max_size is reached.
+    - Optional JSON backing file so a restarted process starts warm.
+      Persistent caches need str keys and JSON-serializable values.
+      With autosave=False changes only mark the cache `dirty`, the owner calls save()
+      off the event loop (e.g. through fs.run). Likewise load=False leaves reading the file
+      to the owner's load() call.
+    - Expired entries stay until evicted, get_stale() can still serve them while the LMS is down.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        default_ttl: float = 300.0,
+        path: Optional[str] = None,
+        autosave: bool = True,
+        load: bool = True,
+    ):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.path = path
+        self.autosave = autosave
+        self.dirty = False
+        self.loaded = not path
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.RLock()
+        if path and load:
+            self.load()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at < time.time():
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """The value even if it expired (a fallback when it can't be refreshed)."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return default if entry is _MISSING else entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            ttl = self.default_ttl if ttl is None else ttl
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._changed()
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drops one key, or everything when key is None."""
+        with self._lock:
+            self._skip_load()
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self._changed()
+
+    def invalidate_prefix(self, prefix: str):
+        """Drops every str key starting with prefix (e.g. all 'courses:' entries)."""
+        with self._lock:
+            self._skip_load()
+            for key in [k for k in self._data if isinstance(k, str) and k.startswith(prefix)]:
+                del self._data[key]
+            self._changed()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # --- Disk persistence ---
+
+    def load(self):
+        """Reads the backing file once. Blocking, entries set in the meantime win over the file."""
+        with self._lock:
+            if self.loaded:
+                return
+            self.loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache file {self.path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            # File entries are older than anything set since, they go to the LRU end
+            data = OrderedDict((k, (e, v)) for k, (e, v) in raw.items() if e > now and k not in self._data)
+            data.update(self._data)
+            self._data = data
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            count = len(self._data)
+        logger.info(f"Loaded {count} cached entries from {self.path}")
+
+    def _skip_load(self):
+        # Invalidated before the file was read: loading it later would bring dropped entries back
+        self.loaded = True
+
+    def _changed(self):
+        if not self.path:
+            return
+        if self.autosave:
+            self.save()
+        else:
+            self.dirty = True
+
+    def save(self):
+        """Writes the backing file. Blocking, the entries are copied under the lock first."""
+        if not self.path:
+            return
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._data.items()}
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Could not persist cache to {self.path}: {e}")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent async calls: while a call for `key` is in flight, later callers
+    with the same key await the same result instead of starting their own.
+    A caller being cancelled never cancels the shared call.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._forget(key, t))
+        else:
+            logger.info(f"Joining in-flight call for {key!r}")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark exceptions as retrieved if every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._inflight)
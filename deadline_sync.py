@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+import fs
+import state
+from moodle_client import MoodleClient, get_client
+
+logger = logging.getLogger(__name__)
+
+# Moodle rejects limitnum above 50 for action events
+EVENTS_PAGE_SIZE = 50
+
+# Poll the LMS every DEADLINE_SYNC_INTERVAL seconds. Every DEADLINE_FULL_SYNC_EVERY-th poll
+# rebuilds the snapshot from scratch so deleted or moved deadlines disappear.
+DEADLINE_SYNC_INTERVAL = float(os.getenv("DEADLINE_SYNC_INTERVAL", 300))
+DEADLINE_FULL_SYNC_EVERY = int(os.getenv("DEADLINE_FULL_SYNC_EVERY", 6))
+# A snapshot younger than this is served as-is, older ones trigger a live fetch
+DEADLINE_SNAPSHOT_MAX_AGE = float(os.getenv("DEADLINE_SNAPSHOT_MAX_AGE", 2 * DEADLINE_SYNC_INTERVAL))
+# If the LMS is down, snapshots up to this old are still served (with a note)
+DEADLINE_STALE_GRACE = float(os.getenv("DEADLINE_STALE_GRACE", 6 * 3600))
+DEADLINE_SNAPSHOT_FILE = os.getenv(
+    "DEADLINE_SNAPSHOT_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".smartsubmit_deadlines.json"),
+)
+
+# Only these event fields are kept in the snapshot
+EVENT_FIELDS = ("id", "name", "instance", "modulename", "timesort", "formattedtime", "url")
+
+
+async def iter_action_events(
+    client: MoodleClient,
+    timesortfrom: int,
+    page_size: int = EVENTS_PAGE_SIZE,
+    after_id: Optional[int] = None,
+) -> AsyncIterator[dict]:
+    """
+    Streams calendar action events page by page (limitnum/aftereventid).
+    The next page is prefetched while the caller works on the current one,
+    and breaking out of the loop stops fetching.
+    """
+    async def fetch_page(after: Optional[int]) -> List[dict]:
+        data = await client.call(
+            "core_calendar_get_action_events_by_timesort",
+            timesortfrom=timesortfrom,
+            limitnum=page_size,
+            aftereventid=after,
+        )
+        return data.get("events", []) if isinstance(data, dict) else []
+
+    next_page = asyncio.create_task(fetch_page(after_id))
+    try:
+        while True:
+            events = await next_page
+            next_page = None
+            if len(events) >= page_size:
+                next_page = asyncio.create_task(fetch_page(events[-1]["id"]))
+            for e in events:
+                yield e
+            if next_page is None:
+                return
+    finally:
+        if next_page is not None and not next_page.done():
+            next_page.cancel()
+
+
+def _trim(event: dict) -> dict:
+    trimmed = {k: event.get(k) for k in EVENT_FIELDS}
+    course = event.get("course") or {}
+    trimmed["course"] = {"id": course.get("id"), "fullname": course.get("fullname")}
+    return trimmed
+
+
+class DeadlineSnapshot:
+    """Upcoming action events by id, plus a (timesort, id) ordered view rebuilt on change."""
+
+    def __init__(self, events: Optional[Dict[int, dict]] = None, synced_at: float = 0.0):
+        self.events: Dict[int, dict] = events or {}
+        self.synced_at = synced_at
+        self._ordered: List[dict] = []
+        self._reorder()
+
+    def _reorder(self):
+        self._ordered = sorted(self.events.values(), key=lambda e: (e.get("timesort") or 0, e["id"]))
+
+    def replace(self, events: List[dict]):
+        self.events = {e["id"]: _trim(e) for e in events}
+        self._reorder()
+
+    def merge(self, events: List[dict]):
+        for e in events:
+            self.events[e["id"]] = _trim(e)
+        self._reorder()
+
+    def merge_window(self, page: List[dict]):
+        """
+        Merges a complete page starting at "now". Known events sorting inside the page's
+        range but missing from it were deleted or moved, so they are dropped.
+        """
+        end = (page[-1].get("timesort") or 0, page[-1]["id"])
+        ids = {e["id"] for e in page}
+        for event_id, e in list(self.events.items()):
+            if (e.get("timesort") or 0, event_id) <= end and event_id not in ids:
+                del self.events[event_id]
+        self.merge(page)
+
+    def upcoming(self, now: Optional[float] = None) -> List[dict]:
+        """Events not yet due, earliest first."""
+        now = now if now is not None else time.time()
+        return [e for e in self._ordered if (e.get("timesort") or 0) >= now]
+
+    @property
+    def last(self) -> Optional[dict]:
+        return self._ordered[-1] if self._ordered else None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.synced_at if self.synced_at else float("inf")
+
+    def to_json(self) -> dict:
+        return {"synced_at": self.synced_at, "events": list(self.events.values())}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "DeadlineSnapshot":
+        return cls({e["id"]: e for e in data.get("events", [])}, data.get("synced_at", 0.0))
+
+
+class DeadlineSync:
+    """
+    Background task keeping a local snapshot of upcoming deadlines.
+    Incremental polls re-read the first page from now (new or changed near-term deadlines)
+    and continue after the last known event (newly appended ones). A periodic full
+    sync drops deadlines that were deleted or moved.
+    """
+
+    def __init__(
+        self,
+        client: MoodleClient,
+        path: Optional[str] = DEADLINE_SNAPSHOT_FILE,
+        interval: float = DEADLINE_SYNC_INTERVAL,
+        full_every: int = DEADLINE_FULL_SYNC_EVERY,
+    ):
+        self.client = client
+        self.path = path
+        self.interval = interval
+        self.full_every = max(1, full_every)
+        self.snapshot = DeadlineSnapshot()
+        self._polls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Sync ---
+
+    async def sync_once(self, full: bool = False) -> int:
+        """Runs one sync pass. Returns the number of events in the snapshot."""
+        now_ts = int(time.time())
+        if full or not self.snapshot.events:
+            events = [e async for e in iter_action_events(self.client, now_ts)]
+            self.snapshot.replace(events)
+            kind = "full"
+        else:
+            data = await self.client.call(
+                "core_calendar_get_action_events_by_timesort",
+                timesortfrom=now_ts,
+                limitnum=EVENTS_PAGE_SIZE,
+            )
+            head = data.get("events", []) if isinstance(data, dict) else []
+            if len(head) < EVENTS_PAGE_SIZE:
+                # The first page holds every upcoming event, nothing else to fetch
+                self.snapshot.replace(head)
+            else:
+                # Everything up to the end of the first page is authoritative
+                self.snapshot.merge_window(head)
+                last = self.snapshot.last
+                tail = [e async for e in iter_action_events(
+                    self.client, last.get("timesort") or now_ts, after_id=last["id"])]
+                self.snapshot.merge(tail)
+            kind = "incremental"
+        self.snapshot.synced_at = time.time()
+        await fs.run(self._save)
+        logger.info(f"Deadline sync ({kind}): {len(self.snapshot.events)} events in snapshot.")
+        return len(self.snapshot.events)
+
+    async def _run(self):
+        delay = 0.0 if self.snapshot.age > self.interval else self.interval - self.snapshot.age
+        failures = 0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                full = self._polls % self.full_every == 0
+                await self.sync_once(full=full)
+                self._polls += 1
+                failures = 0
+                delay = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                # Back off while the LMS is struggling, but keep trying
+                delay = min(self.interval * 2 ** failures, 3600)
+                logger.warning(f"Deadline sync failed ({failures}x), retrying in {delay:.0f}s: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Deadline sync started (every {self.interval:.0f}s).")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # --- Persistence ---
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable deadline snapshot {self.path}: {e}")
+            return
+        if data.get("account") != self.client.fingerprint:
+            return
+        self.snapshot = DeadlineSnapshot.from_json(data)
+        logger.info(f"Loaded deadline snapshot ({len(self.snapshot.events)} events, {self.snapshot.age:.0f}s old).")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"account": self.client.fingerprint, **self.snapshot.to_json()}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Could not persist deadline snapshot: {e}")
+
+
+def current_engine() -> Optional[DeadlineSync]:
+    """The running sync engine, if server.py / webhook.py started one."""
+    engine = state.get("deadline_sync.engine")
+    return engine if engine is not None and engine.running else None
+
+
+async def start_engine() -> Optional[DeadlineSync]:
+    client = get_client()
+    if not client.configured:
+        logger.warning("Deadline sync disabled: MOODLE_TOKEN or MOODLE_URL not set.")
+        return None
+    engine = state.get("deadline_sync.engine")
+    if engine is None or engine.client is not client:
+        engine = state.put("deadline_sync.engine", DeadlineSync(client))
+        try:
+            await fs.run(engine._load)
+        except asyncio.TimeoutError:
+            logger.warning(f"Reading {engine.path} timed out, starting with an empty deadline snapshot.")
+    engine.start()
+    return engine
+
+
+async def stop_engine():
+    engine = state.get("deadline_sync.engine")
+    if engine is not None:
+        await engine.stop()
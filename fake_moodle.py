@@ -0,0 +1,275 @@
+"""
+Local Moodle stand-in for benchmarks and offline development.
+Implements webservice/rest/server.php, webservice/upload.php and webservice/pluginfile.php
+for the wsfunctions SmartSubmit uses, with configurable latency, data sizes and failures.
+
+Run it standalone:  python fake_moodle.py --events 2000 --latency 0.08
+then point MOODLE_URL at http://127.0.0.1:8765/webservice/rest/server.php
+"""
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+FAKE_TOKEN = "fake-token"
+FAKE_USER_ID = 4242
+
+
+@dataclass
+class FakeMoodleConfig:
+    courses: int = 8
+    events: int = 200                  # upcoming assignment deadlines, spread over the courses
+    latency: float = 0.05              # seconds added to every request
+    jitter: float = 0.02               # +- uniform random extra latency
+    failure_rate: float = 0.0          # share of requests that fail
+    failure_mode: str = "http"         # "http" (503) or "moodle" (exception payload)
+    upload_throughput: float = 0.0     # bytes/s simulated for upload.php, 0 = unlimited
+    hang_seconds: float = 30.0         # how long a scripted "hang" fault holds the request before a 503
+    intro_size: int = 2000             # bytes of HTML intro per assignment (payload size)
+    seed: int = 1
+
+
+@dataclass
+class _Submission:
+    status: str = "new"
+    draft_itemid: Optional[int] = None
+
+
+class FakeMoodle:
+    """Generated LMS data plus the mutable state of draft areas and submissions."""
+
+    def __init__(self, config: Optional[FakeMoodleConfig] = None):
+        self.config = config or FakeMoodleConfig()
+        self.random = random.Random(self.config.seed)
+        self.requests = 0
+        self.calls: Dict[str, int] = {}
+        # Accepted tokens -> user id, add_user() registers more accounts (one per tenant)
+        self.users: Dict[str, int] = {FAKE_TOKEN: FAKE_USER_ID}
+        self.token_calls: Dict[str, int] = {}
+        # Scripted failures for the next requests, in order: "http" (503), "moodle" (exception payload)
+        # or "hang" (the request arrived but is only answered after hang_seconds)
+        self.faults: List[str] = []
+        self.reset()
+
+    def add_user(self, token: str, userid: int):
+        self.users[token] = userid
+
+    def reset(self):
+        cfg = self.config
+        now = int(time.time())
+        self.courses = [
+            {"id": 1000 + c, "fullname": f"Course {c} Fullname", "shortname": f"C{c}"} for c in range(cfg.courses)
+        ]
+        self.assignments: List[dict] = []
+        self.events: List[dict] = []
+        for i in range(cfg.events):
+            course = self.courses[i % cfg.courses]
+            instance, cmid = 5000 + i, 90000 + i
+            timesort = now + 3600 + i * 600
+            self.assignments.append({
+                "id": instance, "cmid": cmid, "course": course["id"], "name": f"Lab {i + 1:02d}",
+                "duedate": timesort, "intro": "<p>" + "x" * cfg.intro_size + "</p>",
+            })
+            self.events.append({
+                "id": 700000 + i, "name": f"Lab {i + 1:02d} is due", "instance": instance, "modulename": "assign",
+                "timesort": timesort, "formattedtime": time.strftime("%A, %d %B %Y, %I:%M %p", time.localtime(timesort)),
+                "url": f"https://fake-moodle/mod/assign/view.php?id={cmid}",
+                "course": {"id": course["id"], "fullname": course["fullname"]},
+            })
+        self.events.sort(key=lambda e: (e["timesort"], e["id"]))
+        self.by_cmid = {a["cmid"]: a for a in self.assignments}
+        self.drafts: Dict[int, Dict[str, dict]] = {}   # itemid -> filename -> {size, sha1}
+        self.submissions: Dict[int, _Submission] = {}
+        self._next_itemid = 1
+
+    # --- wsfunctions ---
+
+    def site_info(self, q):
+        return {"userid": self.users.get(q.get("wstoken"), FAKE_USER_ID), "username": "student", "fullname": "Fake Student", "sitename": "Fake LMS"}
+
+    def users_courses(self, q):
+        return self.courses
+
+    def action_events(self, q):
+        since = int(q.get("timesortfrom", 0))
+        limit = min(int(q.get("limitnum", 20)), 50)
+        after = q.get("aftereventid")
+        events = [e for e in self.events if e["timesort"] >= since]
+        if after is not None:
+            ids = [e["id"] for e in events]
+            after = int(after)
+            events = events[ids.index(after) + 1:] if after in ids else []
+        return {"events": events[:limit], "firstid": events[0]["id"] if events else 0}
+
+    def course_module(self, q):
+        a = self.by_cmid.get(int(q.get("cmid", 0)))
+        if a is None:
+            return {"exception": "dml_missing_record_exception", "errorcode": "invalidrecord", "message": "Can't find data record in database table course_modules."}
+        return {"cm": {"id": a["cmid"], "course": a["course"], "modname": "assign", "instance": a["id"]}}
+
+    def assignments_by_course(self, q):
+        courses = {}
+        for a in self.assignments:
+            courses.setdefault(a["course"], []).append(a)
+        return {"courses": [{"id": cid, "assignments": items} for cid, items in courses.items()], "warnings": []}
+
+    def save_submission(self, q):
+        sub = self.submissions.setdefault(int(q["assignmentid"]), _Submission())
+        sub.draft_itemid = int(q.get("plugindata[files_filemanager]", 0))
+        sub.status = "draft"
+        return []
+
+    def submit_for_grading(self, q):
+        sub = self.submissions.get(int(q["assignmentid"]))
+        if sub is None or sub.draft_itemid is None:
+            return [{"item": "assign", "warningcode": "couldnotsubmitforgrading", "message": "Nothing to submit"}]
+        sub.status = "submitted"
+        return []
+
+    def submission_status(self, q):
+        assign_id = int(q["assignid"])
+        sub = self.submissions.get(assign_id, _Submission())
+        files = [
+            {"filename": name, "filesize": meta["size"], "contenthash": meta["sha1"],
+             "fileurl": f"http://fake-moodle/webservice/pluginfile.php/1/assignsubmission_file/submission_files/{sub.draft_itemid}/{name}"}
+            for name, meta in self.drafts.get(sub.draft_itemid, {}).items()
+        ]
+        return {"lastattempt": {"submission": {"id": assign_id, "status": sub.status, "plugins": [
+            {"type": "file", "fileareas": [{"area": "submission_files", "files": files}]}
+        ]}}}
+
+    FUNCTIONS = {
+        "core_webservice_get_site_info": site_info,
+        "core_enrol_get_users_courses": users_courses,
+        "core_calendar_get_action_events_by_timesort": action_events,
+        "core_course_get_course_module": course_module,
+        "mod_assign_get_assignments": assignments_by_course,
+        "mod_assign_save_submission": save_submission,
+        "mod_assign_submit_for_grading": submit_for_grading,
+        "mod_assign_get_submission_status": submission_status,
+    }
+
+    # --- request plumbing ---
+
+    async def delay(self):
+        cfg = self.config
+        extra = self.random.uniform(-cfg.jitter, cfg.jitter) if cfg.jitter else 0.0
+        await asyncio.sleep(max(0.0, cfg.latency + extra))
+
+    async def failure(self) -> Optional[Response]:
+        cfg = self.config
+        if self.faults:
+            mode = self.faults.pop(0)
+        elif cfg.failure_rate > 0 and self.random.random() < cfg.failure_rate:
+            mode = cfg.failure_mode
+        else:
+            return None
+        if mode == "hang":
+            await asyncio.sleep(cfg.hang_seconds)
+        elif mode == "moodle":
+            return JSONResponse({"exception": "moodle_exception", "errorcode": "servicebusy", "message": "Service temporarily unavailable"})
+        return Response("Service Unavailable", status_code=503)
+
+    def count(self, name: str, token: Optional[str] = None):
+        self.requests += 1
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if token is not None:
+            self.token_calls[token] = self.token_calls.get(token, 0) + 1
+
+
+async def _read_upload(request: Request):
+    """Reads the single-file multipart body. Returns (filename, size, sha1) of the file part."""
+    boundary = request.headers["content-type"].split("boundary=")[1].encode()
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+    head, _, rest = bytes(body).partition(b"\r\n\r\n")
+    data = rest[: rest.rfind(b"\r\n--" + boundary)]
+    name = head.split(b'filename="', 1)[1].split(b'"', 1)[0].decode()
+    return name, len(data), hashlib.sha1(data).hexdigest()
+
+
+def create_app(fake: Optional[FakeMoodle] = None) -> FastAPI:
+    fake = fake or FakeMoodle()
+    app = FastAPI(title="Fake Moodle")
+    app.state.fake = fake
+
+    @app.api_route("/webservice/rest/server.php", methods=["GET", "POST"])
+    async def server_php(request: Request):
+        q = dict(request.query_params)
+        if request.method == "POST":
+            q.update(dict(await request.form()))
+        wsfunction = q.get("wsfunction", "")
+        fake.count(wsfunction, q.get("wstoken"))
+        await fake.delay()
+        if q.get("wstoken") not in fake.users:
+            return JSONResponse({"exception": "moodle_exception", "errorcode": "invalidtoken", "message": "Invalid token - token not found"})
+        failed = await fake.failure()
+        if failed is not None:
+            return failed
+        handler = FakeMoodle.FUNCTIONS.get(wsfunction)
+        if handler is None:
+            return JSONResponse({"exception": "webservice_access_exception", "errorcode": "accessexception", "message": f"Access control exception ({wsfunction})"})
+        return JSONResponse(handler(fake, q))
+
+    @app.post("/webservice/upload.php")
+    async def upload_php(request: Request):
+        fake.count("upload", request.query_params.get("token"))
+        await fake.delay()
+        if request.query_params.get("token") not in fake.users:
+            return JSONResponse({"exception": "moodle_exception", "errorcode": "invalidtoken", "message": "Invalid token"})
+        failed = await fake.failure()
+        if failed is not None:
+            return failed
+        name, size, sha1 = await _read_upload(request)
+        if fake.config.upload_throughput > 0:
+            await asyncio.sleep(size / fake.config.upload_throughput)
+        itemid = int(request.query_params.get("itemid") or 0)
+        if not itemid:
+            itemid = fake._next_itemid
+            fake._next_itemid += 1
+        fake.drafts.setdefault(itemid, {})[name] = {"size": size, "sha1": sha1}
+        return JSONResponse([{"component": "user", "contextid": 1, "userid": str(FAKE_USER_ID), "filearea": "draft",
+                              "filename": name, "filepath": "/", "itemid": itemid, "license": "allrightsreserved"}])
+
+    @app.get("/webservice/pluginfile.php/{path:path}")
+    async def pluginfile(path: str):
+        # Only metadata is kept, so downloads serve deterministic filler of the right size
+        fake.count("pluginfile")
+        await fake.delay()
+        itemid, name = path.split("/")[-2:]
+        meta = fake.drafts.get(int(itemid), {}).get(name)
+        if meta is None:
+            return Response("Not found", status_code=404)
+        return Response(b"\0" * meta["size"], media_type="application/octet-stream")
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake Moodle LMS for local testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--courses", type=int, default=8)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-mode", choices=["http", "moodle"], default="http")
+    parser.add_argument("--upload-throughput", type=float, default=0.0, help="bytes/s, 0 = unlimited")
+    args = parser.parse_args()
+
+    config = FakeMoodleConfig(
+        courses=args.courses, events=args.events, latency=args.latency, jitter=args.jitter,
+        failure_rate=args.failure_rate, failure_mode=args.failure_mode, upload_throughput=args.upload_throughput,
+    )
+    print(f"Fake Moodle on http://{args.host}:{args.port}/webservice/rest/server.php (token: {FAKE_TOKEN})")
+    uvicorn.run(create_app(FakeMoodle(config)), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,172 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Filter extensions (PDF, Word, Excel, ZIP)
+ALLOWED_EXTS = ('.pdf', '.docx', '.doc', '.zip', '.xlsx', '.xls', '.csv')
+
+# Folders that never contain submissions but can hold millions of files
+SKIP_DIRS = {'node_modules', '__pycache__', '.git', '.venv', 'venv', '$RECYCLE.BIN', 'System Volume Information'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path   TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime  REAL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    dir   TEXT NOT NULL,
+    name  TEXT NOT NULL,
+    size  INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+"""
+
+
+def _subtree(column: str, path: str) -> Tuple[str, tuple]:
+    """SQL clause matching path and everything below it. Range form so the index is used."""
+    prefix = path.rstrip(os.sep) + os.sep
+    upper = prefix[:-1] + chr(ord(os.sep) + 1)
+    return f"({column} = ? OR ({column} >= ? AND {column} < ?))", (path, prefix, upper)
+
+
+class FileIndex:
+    """
+    Persistent SQLite catalog of report files under one or more roots.
+    refresh() walks the tree with os.scandir, but only re-lists directories
+    whose mtime changed since the last walk. Unchanged directories cost one stat.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._last_refresh: Dict[str, float] = {}
+        # Bumped whenever the catalog changes, lets callers cache derived data
+        self.generation = 0
+
+    def refresh(self, root: str, min_interval: float = 0.0, cancel: Optional[threading.Event] = None) -> int:
+        """
+        Brings the catalog for root up to date. Returns the number of re-listed directories.
+        Skipped entirely if root was refreshed less than min_interval seconds ago.
+        Disk access happens outside the lock, so several roots can be refreshed in parallel threads.
+        Setting `cancel` stops the walk early, directories re-listed so far are kept.
+        """
+        root = os.path.abspath(root)
+        now = time.monotonic()
+        if min_interval and now - self._last_refresh.get(root, float("-inf")) < min_interval:
+            return 0
+
+        rescanned = 0
+        stack = [root]
+        try:
+            while stack:
+                if cancel is not None and cancel.is_set():
+                    logger.warning(f"File index: refresh of {root} cancelled after {rescanned} directories")
+                    return rescanned
+                path = stack.pop()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    with self._lock:
+                        self._forget_tree(path)
+                    continue
+
+                with self._lock:
+                    row = self._db.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+                    if row is not None and row[0] == mtime:
+                        # Nothing added/removed/renamed here, descend into the known children only
+                        stack.extend(r[0] for r in self._db.execute(
+                            "SELECT path FROM dirs WHERE parent = ?", (path,)))
+                        continue
+
+                listing = self._list_dir(path)
+                if listing is None:
+                    continue
+                files, subdirs = listing
+                with self._lock:
+                    self._store_dir(path, mtime, files, subdirs)
+                rescanned += 1
+                stack.extend(subdirs)
+
+            self._last_refresh[root] = now
+            if rescanned:
+                logger.info(f"File index: re-listed {rescanned} directories under {root}")
+            return rescanned
+        finally:
+            with self._lock:
+                self._db.commit()
+                if rescanned:
+                    self.generation += 1
+
+    def _list_dir(self, path: str) -> Optional[Tuple[list, List[str]]]:
+        """Reads one directory from disk: ([(path, dir, name, size, mtime)], subdirs)."""
+        files: List[Tuple[str, str, str, int, float]] = []
+        subdirs: List[str] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in SKIP_DIRS:
+                                subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(ALLOWED_EXTS):
+                            st = entry.stat()
+                            files.append((entry.path, path, entry.name, st.st_size, st.st_mtime))
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"File index: cannot list {path}: {e}")
+            return None
+        return files, subdirs
+
+    def _store_dir(self, path: str, mtime: float, files: list, subdirs: List[str]):
+        parent = os.path.dirname(path)
+        self._db.execute(
+            "INSERT OR REPLACE INTO dirs(path, parent, mtime) VALUES (?, ?, ?)",
+            (path, parent if parent != path else None, mtime),
+        )
+        self._db.execute("DELETE FROM files WHERE dir = ?", (path,))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files(path, dir, name, size, mtime) VALUES (?, ?, ?, ?, ?)", files
+        )
+
+        # Children that disappeared take their whole subtree with them
+        current = set(subdirs)
+        for (child,) in self._db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)).fetchall():
+            if child not in current:
+                self._forget_tree(child)
+        for sub in subdirs:
+            self._db.execute(
+                "INSERT OR IGNORE INTO dirs(path, parent, mtime) VALUES (?, ?, NULL)", (sub, path)
+            )
+
+    def _forget_tree(self, path: str):
+        clause, args = _subtree("path", path)
+        self._db.execute(f"DELETE FROM dirs WHERE {clause}", args)
+        clause, args = _subtree("dir", path)
+        self._db.execute(f"DELETE FROM files WHERE {clause}", args)
+
+    def files(self, roots: Iterable[str]) -> List[Tuple[str, str, int, float]]:
+        """All indexed (path, name, size, mtime) rows under the given roots."""
+        results = {}
+        with self._lock:
+            for root in roots:
+                clause, args = _subtree("dir", os.path.abspath(root))
+                rows = self._db.execute(f"SELECT path, name, size, mtime FROM files WHERE {clause}", args)
+                for row in rows:
+                    results[row[0]] = row
+        return list(results.values())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
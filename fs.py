@@ -0,0 +1,270 @@
+import os
+import asyncio
+import logging
+import zipfile
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, List, Optional, Tuple, TypeVar
+
+import state
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# Filesystem calls run on their own small pool, not the event loop and not asyncio's default
+# executor. A hanging network share or OneDrive placeholder can then only tie up these
+# threads, while MCP and webhook requests keep being served.
+FS_WORKERS = int(os.getenv("FS_WORKERS", 8))
+# Default time limit for one filesystem operation (seconds), None = wait forever
+FS_TIMEOUT = float(os.getenv("FS_TIMEOUT", 30))
+READ_CHUNK_SIZE = 256 * 1024
+# A streamed ZIP buffers at most this many chunks between the writer thread and its reader.
+# Each writer has a thread of its own: it lives as long as the upload, on the pool it would
+# starve every other filesystem call.
+ZIP_QUEUE_CHUNKS = 4
+# Streamed ZIPs store their entries uncompressed: the archive length then follows from the file
+# sizes alone and can be sent as Content-Length (some PHP front ends drop chunked multipart
+# uploads). Lab submissions are mostly PDFs, Office files and images, compressed already.
+
+_executor: ThreadPoolExecutor = state.keep(
+    "fs.executor", lambda: ThreadPoolExecutor(max_workers=FS_WORKERS, thread_name_prefix="smartsubmit-fs")
+)
+
+
+async def run(fn: Callable[..., T], *args, timeout: Optional[float] = FS_TIMEOUT) -> T:
+    """
+    Runs a blocking fn(*args) on the filesystem pool.
+    Raises asyncio.TimeoutError after `timeout` seconds. The thread itself can't be interrupted,
+    the caller just stops waiting for it (work that hasn't started yet is dropped).
+    """
+    future = asyncio.get_running_loop().run_in_executor(_executor, lambda: fn(*args))
+    return await asyncio.wait_for(future, timeout)
+
+
+async def run_cancellable(
+    fn: Callable[..., T], *args, timeout: Optional[float] = FS_TIMEOUT
+) -> T:
+    """
+    Like run(), for long jobs that accept a `cancel` threading.Event (e.g. FileIndex.refresh).
+    The event is set when the caller times out or is cancelled, so the worker stops early
+    instead of finishing a scan nobody waits for.
+    """
+    cancel = threading.Event()
+    try:
+        return await run(lambda: fn(*args, cancel=cancel), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        cancel.set()
+        raise
+
+
+async def exists(path: str, timeout: Optional[float] = FS_TIMEOUT) -> bool:
+    return await run(os.path.exists, path, timeout=timeout)
+
+
+async def isdir(path: str, timeout: Optional[float] = FS_TIMEOUT) -> bool:
+    return await run(os.path.isdir, path, timeout=timeout)
+
+
+async def getsize(path: str, timeout: Optional[float] = FS_TIMEOUT) -> int:
+    return await run(os.path.getsize, path, timeout=timeout)
+
+
+async def stat(path: str, timeout: Optional[float] = FS_TIMEOUT) -> os.stat_result:
+    return await run(os.stat, path, timeout=timeout)
+
+
+async def read_chunks(
+    path: str, chunk_size: int = READ_CHUNK_SIZE, timeout: Optional[float] = FS_TIMEOUT
+) -> AsyncIterator[bytes]:
+    """Streams a file in chunks. Open, every read and close happen on the pool, `timeout` applies to each."""
+    f = await run(open, path, "rb", timeout=timeout)
+    try:
+        while True:
+            chunk = await run(f.read, chunk_size, timeout=timeout)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        _executor.submit(f.close)
+
+
+# (path on disk, name inside the archive, size in bytes)
+ZipEntry = Tuple[str, str, int]
+
+
+def zip_entries(paths: List[str]) -> List[ZipEntry]:
+    """
+    What a ZIP of `paths` contains. Files go in by name, directories recursively under their
+    own name (hidden files and folders skipped). Blocking, call it through run().
+    """
+    entries, names = [], set()
+
+    def add(path: str, arcname: str):
+        if arcname in names:
+            logger.warning(f"Skipping {path}: '{arcname}' is already in the archive.")
+            return
+        names.add(arcname)
+        entries.append((path, arcname, os.path.getsize(path)))
+
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            add(path, os.path.basename(path))
+            continue
+        parent = os.path.dirname(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                if not name.startswith("."):
+                    full = os.path.join(dirpath, name)
+                    add(full, os.path.relpath(full, parent).replace(os.sep, "/"))
+    return entries
+
+
+def zip_size(entries: List[ZipEntry]) -> int:
+    """
+    Exact length of the ZIP that zip_stream(entries) produces, from names and sizes alone.
+    Mirrors what zipfile writes for a stored entry declared with its size on an unseekable
+    stream: local header (+ zip64 sizes), data, data descriptor, then the central directory.
+    """
+    limit = zipfile.ZIP64_LIMIT
+    offset = central = 0
+    for _, arcname, size in entries:
+        name = len(arcname.encode("utf-8"))
+        zip64 = size * 1.05 > limit  # zipfile's own margin for the local header
+        header_offset = offset
+        offset += zipfile.sizeFileHeader + name + (20 if zip64 else 0) + size + (24 if zip64 else 16)
+        fields = (2 if size > limit else 0) + (1 if header_offset > limit else 0)
+        central += zipfile.sizeCentralDir + name + (4 + 8 * fields if fields else 0)
+    total = offset + central + zipfile.sizeEndCentDir
+    if len(entries) > zipfile.ZIP_FILECOUNT_LIMIT or offset > limit or central > limit:
+        total += zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator
+    return total
+
+
+def _write_zip(fp, entries: List[ZipEntry], copy: Callable, cancel: threading.Event):
+    """
+    Writes the layout zip_size() computes: stored entries declared with their size up front.
+    copy(path, size, dest) writes the entry's data.
+    """
+    with zipfile.ZipFile(fp, "w", zipfile.ZIP_STORED) as zf:
+        for path, arcname, size in entries:
+            if cancel.is_set():
+                raise InterruptedError("ZIP stream cancelled")
+            info = zipfile.ZipInfo(arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = size
+            with zf.open(info, "w") as dest:
+                copy(path, size, dest)
+
+
+class _QueueWriter:
+    """Write-only file for zipfile, hands full chunks to the event loop. Blocks while the queue is full."""
+
+    def __init__(self, loop, queue: asyncio.Queue, chunk_size: int, cancel: threading.Event):
+        self.loop = loop
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.cancel = cancel
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _put(self, chunk: bytes):
+        if self.cancel.is_set():
+            raise InterruptedError("ZIP stream cancelled")
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if self.cancel.is_set():
+                    future.cancel()
+                    raise InterruptedError("ZIP stream cancelled")
+
+
+async def zip_stream(entries: List[ZipEntry], chunk_size: int = READ_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Streams a ZIP of `entries` as it is being built, without a temporary file.
+    The archive is written by a thread of its own into a small bounded queue, so memory stays
+    at a few chunks however big the folder is, and the writer stops when the reader goes away.
+    Its length is exactly zip_size(entries).
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ZIP_QUEUE_CHUNKS)
+
+    def copy(path: str, size: int, dest):
+        # Exactly the size zip_size() counted, a file that changed since would break the length
+        with open(path, "rb") as src:
+            left = size
+            while left:
+                data = src.read(min(chunk_size, left))
+                if not data:
+                    break
+                dest.write(data)
+                left -= len(data)
+            if left or src.read(1):
+                raise OSError(f"{path} changed while it was being zipped, please try again.")
+
+    cancel = threading.Event()
+    writer_task: asyncio.Future = loop.create_future()
+
+    def finished(error: Optional[BaseException]):
+        if writer_task.done():
+            return
+        if error is None:
+            writer_task.set_result(None)
+        else:
+            writer_task.set_exception(error)
+
+    def build():
+        error = None
+        try:
+            writer = _QueueWriter(loop, queue, chunk_size, cancel)
+            # The writer can't seek, zipfile then puts the CRC after each entry's data
+            _write_zip(writer, entries, copy, cancel)
+            writer.close()
+        except BaseException as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(finished, error)
+        except RuntimeError:
+            pass  # The event loop is gone, nobody is waiting any more
+
+    threading.Thread(target=build, name="smartsubmit-zip", daemon=True).start()
+    get = None
+    try:
+        while True:
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait({get, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            if get.done():
+                yield get.result()
+                continue
+            # Writer finished (or failed): hand out what it left in the queue
+            while not queue.empty():
+                yield queue.get_nowait()
+            writer_task.result()
+            return
+    finally:
+        if get is not None:
+            get.cancel()
+        cancel.set()
+        if not writer_task.done():
+            writer_task.cancel()
+        elif not writer_task.cancelled():
+            writer_task.exception()  # already raised above if it mattered, don't log it again
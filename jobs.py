@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")  # Sandbox/business number, e.g. +14155238886
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+# WhatsApp rejects bodies above 1600 characters, longer replies are split
+WHATSAPP_MAX_BODY = 1600
+
+
+def split_message(text: str, limit: int = WHATSAPP_MAX_BODY) -> List[str]:
+    """Splits a reply on line boundaries so every part fits in one WhatsApp message."""
+    parts, current = [], ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts or [""]
+
+
+class TwilioSender:
+    """Sends outbound WhatsApp messages through the Twilio REST API."""
+
+    def __init__(self, account_sid: str, auth_token: str, from_number: str):
+        from twilio.rest import Client
+        self._client = Client(account_sid, auth_token)
+        self.from_number = from_number if from_number.startswith("whatsapp:") else f"whatsapp:{from_number}"
+
+    async def send(self, to: str, body: str):
+        for part in split_message(body):
+            # The Twilio SDK is blocking, keep it off the event loop
+            await asyncio.to_thread(self._client.messages.create, from_=self.from_number, to=to, body=part)
+
+
+class LogSender:
+    """Local stand-in for Twilio: logs replies and keeps them in `sent`. Used when Twilio isn't configured and in tests."""
+
+    def __init__(self):
+        self.sent: List[Tuple[str, str]] = []
+
+    async def send(self, to: str, body: str):
+        logger.info(f"[outbound to {to}] {body}")
+        self.sent.append((to, body))
+
+
+def make_sender():
+    """
+    The logging stub with WHATSAPP_SENDER=log, Twilio when fully configured, None otherwise:
+    without an outbound sender results can't be delivered later, the webhook answers inline.
+    """
+    if os.getenv("WHATSAPP_SENDER", "twilio") == "log":
+        return LogSender()
+    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_NUMBER:
+        return TwilioSender(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER)
+    logger.warning(
+        "TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_NUMBER are not all set: "
+        "slow commands are answered in the webhook reply instead of in the background."
+    )
+    return None
+
+
+@dataclass
+class Job:
+    to: str
+    description: str
+    run: Callable[[], Awaitable[str]]
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class JobQueue:
+    """
+    In-process async worker pool. The webhook enqueues slow commands and answers right away,
+    workers run them and deliver the result through the outbound sender.
+    """
+
+    def __init__(self, sender=None, workers: int = JOB_WORKERS, maxsize: int = JOB_QUEUE_SIZE):
+        self.sender = sender if sender is not None else make_sender()
+        if self.sender is None:
+            raise ValueError("JobQueue needs an outbound sender, see make_sender()")
+        self.workers = workers
+        self._queue: "asyncio.Queue[Job]" = asyncio.Queue(maxsize=maxsize)
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+            logger.info(f"Job queue started with {self.workers} workers.")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Gives queued jobs a chance to finish, then cancels the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Job queue stopped with {self._queue.qsize()} jobs still pending.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, to: str, description: str, run: Callable[[], Awaitable[str]]) -> bool:
+        """Queues a job. Returns False if the queue is full."""
+        try:
+            self._queue.put_nowait(Job(to, description, run))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Job queue full, rejected: {description}")
+            return False
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def _worker(self, n: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                waited = time.monotonic() - job.queued_at
+                logger.info(f"Worker {n} running '{job.description}' for {job.to} (queued {waited:.2f}s)")
+                try:
+                    text = await job.run()
+                except Exception as e:
+                    logger.error(f"Job '{job.description}' failed: {repr(e)}")
+                    text = f"Sorry, '{job.description}' failed: {repr(e)}"
+                try:
+                    await self.sender.send(job.to, text)
+                except Exception as e:
+                    logger.error(f"Could not deliver result of '{job.description}' to {job.to}: {repr(e)}")
+            finally:
+                self._queue.task_done()
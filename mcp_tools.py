@@ -0,0 +1,139 @@
+import os
+from dataclasses import asdict
+from fastmcp import FastMCP, Context
+
+# The tool implementations (tools.py and everything behind it: LMS client, file index,
+# search) are imported on first use, so the MCP server answers the handshake right away.
+# Lookups go through the module each call, which also picks up hot-reloaded code.
+
+
+async def list_documents(
+    directory: str = None,
+    query: str = None,
+    limit: int = 20,
+    sort: str = None,
+    cursor: str = None,
+    format: str = "text",
+) -> str:
+    """
+    REQUIRED: Use this tool to list files on the USER'S local computer.
+    Do NOT check /mnt/ or cloud paths.
+    Lists documents (PDF, Word, Excel, ZIP) from the configured local directories, including subfolders.
+    Use 'query' to filter by name (e.g. 'Lab 1', 'Financial Report'). Fuzzy: abbreviations
+    and number variants match too ('bda lab 3' finds 'Big_Data_Analytics_LAB_03.zip').
+    Results are ranked best match first and come in pages of 'limit'. If more are available the
+    answer ends with a cursor: pass it back (same tool, other arguments ignored) for the next page.
+    sort: 'score' (best match, default with a query), 'mtime' (newest first) or 'name'.
+    format: 'text' (full paths) or 'json' (compact, includes size, mtime and score).
+    """
+    import fs
+    import tools
+
+    if cursor:
+        # Next page of an earlier listing, served from cache without touching the disk
+        return await tools.list_lab_files([], limit=limit, cursor=cursor, format=format)
+
+    target_dir = directory or os.getenv("LAB_DIRECTORY", "E:\\Downloads")
+    # Extra configured folders are only searched when no explicit directory was asked for.
+    # Missing ones are skipped by list_lab_files.
+    extra_dirs = [] if directory else list(tools.LAB_EXTRA_DIRS)
+
+    if not await fs.exists(target_dir):
+        # Fallback if preferred dir is missing
+        fallback = os.path.expanduser("~/Downloads")
+        if await fs.exists(fallback):
+            listing = await tools.list_lab_files([fallback] + extra_dirs, query, limit, sort, format=format)
+            if format == "json":
+                return listing
+            return listing + f"\n(Note: Could not find {target_dir}, listing from {fallback} instead)"
+        return f"Error: Could not find directory {target_dir} or {fallback}"
+
+    return await tools.list_lab_files([target_dir] + extra_dirs, query, limit, sort, format=format)
+
+
+async def check_my_deadlines(
+    search_query: str = None,
+    limit: int = None,
+    fresh: bool = False,
+    sort: str = "due",
+    cursor: str = None,
+    format: str = "text",
+) -> str:
+    """
+    REQUIRED: Connects to the User's Real LMS (Moodle) to fetch actual upcoming assignments and deadlines.
+    Use 'limit' to only get the next N deadlines (faster for "what's due next?").
+    Answers come from a copy synced every few minutes. Set 'fresh' to true only when the user
+    needs up-to-the-second data (e.g. a deadline was just changed).
+    If more deadlines match than 'limit', the answer ends with a cursor: pass it back for the next page.
+    sort: 'due' (soonest first), 'course' or 'name'.
+    format: 'text' or 'json' (compact, includes course_id, cmid and the due timestamp).
+    """
+    import tools
+
+    return await tools.check_deadlines(search_query, limit, fresh, sort, cursor, format)
+
+
+def _progress_reporter(ctx: Context = None):
+    async def report(sent: int, total: int, rate: float):
+        if ctx is not None:
+            await ctx.report_progress(sent, total, f"Uploading... {sent / 1048576:.1f}/{total / 1048576:.1f} MB ({rate / 1024:.0f} KiB/s)")
+    return report
+
+
+async def submit_assignment(assignment_id: str, file_path: str, ctx: Context = None) -> str:
+    """
+    Uploads a specific file to a specific assignment ID. Reports upload progress for large files.
+    If file_path is a folder, it is zipped on the fly and submitted as <folder>.zip.
+    """
+    import tools
+
+    return await tools.submit_to_lms(assignment_id, file_path, progress=_progress_reporter(ctx))
+
+
+async def submit_files(
+    assignment_id: str, file_paths: list[str], zip_as: str = None, ctx: Context = None
+) -> str:
+    """
+    Submits SEVERAL files to ONE assignment (e.g. the report PDF and the code ZIP) in one go.
+    Folders in file_paths are zipped on the fly. If the assignment only accepts a single file,
+    set zip_as (e.g. 'Lab3') to pack everything into one Lab3.zip.
+    Use submit_batch instead for different assignments.
+    """
+    import tools
+
+    return await tools.submit_files_to_lms(assignment_id, file_paths, zip_as, progress=_progress_reporter(ctx))
+
+
+async def submit_batch(items: list[dict], max_concurrency: int = None) -> list[dict]:
+    """
+    Submits several files at once, e.g. a whole week of labs.
+    items: list of {"assignment_id": "...", "file_path": "..."} (one file per assignment).
+    Runs the submissions in parallel and returns one result per item with its 'status'
+    (submitted, draft, already_submitted, uploaded or error) and 'message'.
+    max_concurrency: submissions running at once, BATCH_CONCURRENCY from .env by default.
+    """
+    import tools
+
+    if max_concurrency is None:
+        max_concurrency = tools.BATCH_CONCURRENCY
+    results = await tools.submit_batch_to_lms(items, max_concurrency)
+    return [asdict(r) for r in results]
+
+
+def get_metrics() -> str:
+    """
+    Returns the agent's performance counters in Prometheus text format: latency histograms
+    per Moodle web service function and per submission step, error counts and bytes uploaded.
+    Use it to find out why a submission or deadline check was slow.
+    """
+    import metrics
+
+    return metrics.REGISTRY.render()
+
+
+TOOLS = [list_documents, check_my_deadlines, submit_assignment, submit_files, submit_batch, get_metrics]
+
+
+def register(mcp: FastMCP) -> list:
+    """Registers every tool above on the server. Returns their names."""
+    return [mcp.add_tool(fn).name for fn in TOOLS]
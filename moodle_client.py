@@ -0,0 +1,448 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import inspect
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Union
+
+import httpx
+from dotenv import load_dotenv
+
+import fs
+import metrics
+import resilience
+import state
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MOODLE_TOKEN = os.getenv("MOODLE_TOKEN")
+MOODLE_URL = os.getenv("MOODLE_URL") # e.g. https://lms.nust.edu.pk/webservice/rest/server.php
+
+# HTTP/2 needs the optional 'h2' package (pip install httpx[http2]).
+# Opt in with MOODLE_HTTP2=1, we silently stay on HTTP/1.1 if it is missing.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Moodle functions that change state. These go out as POST, everything else as GET.
+WRITE_FUNCTIONS = {
+    "mod_assign_save_submission",
+    "mod_assign_submit_for_grading",
+}
+
+# Per-wsfunction latency budgets (seconds): the whole call, retries of reads included, must
+# finish within it. Unknown functions use DEFAULT_TIMEOUT. See resilience.py.
+DEFAULT_TIMEOUT = 30.0
+UPLOAD_TIMEOUT = 60.0
+WSFUNCTION_TIMEOUTS = {
+    "core_webservice_get_site_info": 15.0,
+    "core_enrol_get_users_courses": 20.0,
+    "core_course_get_course_module": 15.0,
+    "core_calendar_get_action_events_by_timesort": 30.0,
+    "mod_assign_save_submission": 60.0,
+    "mod_assign_submit_for_grading": 60.0,
+    "mod_assign_get_submission_status": 20.0,
+}
+
+# Upload budget grows with file size: UPLOAD_TIMEOUT + size / UPLOAD_MIN_THROUGHPUT
+UPLOAD_MIN_THROUGHPUT = float(os.getenv("UPLOAD_MIN_THROUGHPUT", 64 * 1024))  # bytes/s
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Progress callbacks fire at most this often (seconds), plus once at the end
+PROGRESS_INTERVAL = 0.5
+
+
+# Requests per second allowed against the LMS host (0 = unlimited) and burst size.
+# Keeps batch submissions from hammering the LMS on deadline night.
+MOODLE_RATE_LIMIT = float(os.getenv("MOODLE_RATE_LIMIT", 10))
+MOODLE_RATE_BURST = int(os.getenv("MOODLE_RATE_BURST", 10))
+
+MOODLE_CALL_SECONDS = metrics.histogram(
+    "smartsubmit_moodle_call_seconds", "Latency of Moodle web service calls.", ["wsfunction"]
+)
+MOODLE_ERRORS = metrics.counter(
+    "smartsubmit_moodle_errors_total", "Failed Moodle requests by wsfunction and error kind.", ["wsfunction", "kind"]
+)
+UPLOAD_SECONDS = metrics.histogram("smartsubmit_upload_seconds", "Duration of file uploads to upload.php.")
+UPLOAD_BYTES = metrics.counter("smartsubmit_upload_bytes_total", "File bytes uploaded to Moodle.")
+
+# progress(bytes_sent, total_bytes, bytes_per_second), may be sync or async
+ProgressCallback = Callable[[int, int, float], Union[None, Awaitable[None]]]
+
+
+def upload_timeout(file_size: int) -> float:
+    """Seconds allowed for an upload of file_size bytes on a slow (UPLOAD_MIN_THROUGHPUT) link."""
+    return UPLOAD_TIMEOUT + file_size / UPLOAD_MIN_THROUGHPUT
+
+
+@dataclass
+class UploadResult:
+    response: list   # Moodle's JSON list, response[0]["itemid"] is the draft area
+    sha1: str        # hex digest of the bytes sent
+    size: int
+    elapsed: float
+
+
+class _ProgressReporter:
+    """Throttles progress callbacks so big uploads don't flood the MCP client."""
+
+    def __init__(self, callback: Optional[ProgressCallback], total: int, started: float):
+        self.callback = callback
+        self.total = total
+        self.started = started
+        self._last = 0.0
+
+    async def update(self, sent: int, final: bool = False):
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if not final and now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        throughput = sent / max(now - self.started, 1e-6)
+        try:
+            result = self.callback(sent, self.total, throughput)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.warning(f"Progress callback failed: {e}")
+
+
+class RateLimiter:
+    """Token bucket: `rate` requests per second, bursts of up to `burst`. Waiters queue in order."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class MoodleError(Exception):
+    """Raised when Moodle answers with an exception payload instead of data."""
+
+    def __init__(self, wsfunction: str, payload: dict):
+        self.wsfunction = wsfunction
+        self.payload = payload
+        self.errorcode = payload.get("errorcode")
+        self.message = payload.get("message", "Unknown Moodle error")
+        super().__init__(f"{wsfunction}: {self.message}")
+
+
+def error_kind(e: BaseException) -> str:
+    """Short, low-cardinality label for a failed request (metrics)."""
+    if isinstance(e, MoodleError):
+        return e.errorcode or "moodle"
+    if isinstance(e, resilience.CircuitOpenError):
+        return "circuit_open"
+    if isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"http_{e.response.status_code}"
+    if isinstance(e, httpx.TransportError):
+        return "network"
+    return type(e).__name__
+
+
+class MoodleClient:
+    """
+    Long-lived Moodle REST client.
+    Keeps one pooled httpx.AsyncClient (keep-alive, optional HTTP/2) so tool calls
+    reuse the TCP+TLS connection instead of handshaking with the LMS every time.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        url: Optional[str] = None,
+        http2: Optional[bool] = None,
+        max_connections: int = 20,
+        max_keepalive: int = 10,
+        rate_limit: Optional[float] = None,
+    ):
+        self.token = token if token is not None else MOODLE_TOKEN
+        self.url = url if url is not None else MOODLE_URL
+        if http2 is None:
+            http2 = os.getenv("MOODLE_HTTP2", "0") == "1"
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("MOODLE_HTTP2 requested but 'h2' is not installed. Using HTTP/1.1.")
+            http2 = False
+        self.http2 = http2
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=60.0,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        self._closed = False
+        self.rate_limiter = RateLimiter(
+            MOODLE_RATE_LIMIT if rate_limit is None else rate_limit, MOODLE_RATE_BURST
+        )
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.token and self.url)
+
+    @property
+    def fingerprint(self) -> str:
+        """Short stable id of (site, token), used to key caches without storing the token."""
+        return hashlib.sha1(f"{self.url}|{self.token}".encode()).hexdigest()[:12]
+
+    @property
+    def upload_url(self) -> str:
+        # Derive upload URL from MOODLE_URL (replace rest/server.php with upload.php)
+        # Env: https://lms.nust.edu.pk/webservice/rest/server.php
+        # Target: https://lms.nust.edu.pk/webservice/upload.php
+        return self.url.replace("/rest/server.php", "/upload.php")
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """The underlying pooled client, created on first use. Raises once aclose() was called."""
+        if self._closed:
+            # Reopening would leak a pool nobody closes again
+            raise RuntimeError("MoodleClient was closed")
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=DEFAULT_TIMEOUT,
+                verify=False,
+                http2=self.http2,
+                limits=self._limits,
+            )
+        return self._client
+
+    @property
+    def policy(self) -> resilience.HostPolicy:
+        """Circuit breaker and latency stats of this client's LMS host."""
+        return resilience.for_host(self.url)
+
+    async def call(self, wsfunction: str, **params: Any) -> Any:
+        """
+        Calls a Moodle web service function and returns the decoded JSON.
+        Nested Moodle params are passed as-is, e.g. **{"plugindata[files_filemanager]": 5}.
+        Raises MoodleError if Moodle returns an exception payload, and
+        resilience.CircuitOpenError without calling while the LMS is known to be down.
+        Reads are retried and hedged within the function's budget, writes are sent once.
+        """
+        query: Dict[str, Any] = {
+            "wstoken": self.token,
+            "moodlewsrestformat": "json",
+            "wsfunction": wsfunction,
+        }
+        query.update({k: v for k, v in params.items() if v is not None})
+        budget = WSFUNCTION_TIMEOUTS.get(wsfunction, DEFAULT_TIMEOUT)
+
+        async def request(timeout: float) -> Any:
+            return await self._request(wsfunction, query, timeout)
+
+        try:
+            if wsfunction in WRITE_FUNCTIONS:
+                return await self.policy.once(wsfunction, request, budget)
+            return await self.policy.read(wsfunction, request, budget)
+        except resilience.CircuitOpenError as e:
+            MOODLE_ERRORS.inc(wsfunction=wsfunction, kind=error_kind(e))
+            raise
+
+    async def _request(self, wsfunction: str, query: Dict[str, Any], timeout: float) -> Any:
+        """One HTTP request to server.php."""
+        await self.rate_limiter.acquire()
+        try:
+            with MOODLE_CALL_SECONDS.time(wsfunction=wsfunction):
+                if wsfunction in WRITE_FUNCTIONS:
+                    resp = await self.http.post(self.url, params=query, timeout=timeout)
+                else:
+                    resp = await self.http.get(self.url, params=query, timeout=timeout)
+                resp.raise_for_status()
+                data = resp.json()
+        except Exception as e:
+            MOODLE_ERRORS.inc(wsfunction=wsfunction, kind=error_kind(e))
+            raise
+
+        if isinstance(data, dict) and "exception" in data:
+            e = MoodleError(wsfunction, data)
+            MOODLE_ERRORS.inc(wsfunction=wsfunction, kind=error_kind(e))
+            raise e
+        return data
+
+    async def upload(
+        self,
+        file_path: str,
+        itemid: int = 0,
+        filearea: str = "draft",
+        progress: Optional[ProgressCallback] = None,
+    ) -> UploadResult:
+        """
+        Streams a file to the user's draft area (upload.php) with constant memory.
+        itemid=0 asks Moodle to create a new draft area, pass its itemid to add more files to it.
+        The file is SHA-1 hashed on the way (same digest Moodle stores as contenthash) and
+        `progress` gets (bytes_sent, total_bytes, bytes_per_second) as the upload advances.
+        """
+        file_size = await fs.getsize(file_path)
+        chunks = fs.read_chunks(file_path, UPLOAD_CHUNK_SIZE)
+        return await self.upload_stream(os.path.basename(file_path), chunks, file_size, itemid, filearea, progress)
+
+    async def upload_stream(
+        self,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        size: int,
+        itemid: int = 0,
+        filearea: str = "draft",
+        progress: Optional[ProgressCallback] = None,
+    ) -> UploadResult:
+        """
+        Uploads content produced on the fly (e.g. a ZIP being built) as `filename`.
+        The multipart body is generated chunk by chunk. `size` must be the exact number of
+        bytes `chunks` yields: it is sent as Content-Length, never as a chunked body.
+        """
+        boundary = uuid.uuid4().hex
+        safe_name = filename.replace('"', "%22").replace("\r", "").replace("\n", "")
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        sha1 = hashlib.sha1()
+        stats = {"sent": 0}
+        started = time.monotonic()
+        reporter = _ProgressReporter(progress, size, started)
+
+        async def body() -> AsyncIterator[bytes]:
+            yield head
+            async for chunk in chunks:
+                sha1.update(chunk)
+                stats["sent"] += len(chunk)
+                yield chunk
+                await reporter.update(stats["sent"])
+            yield tail
+
+        upload_params = {
+            "token": self.token,
+            "itemid": itemid,
+            "filearea": filearea,
+        }
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            # Known length up front: some PHP front ends hand a chunked multipart body to Moodle
+            # as an empty $_FILES
+            "Content-Length": str(len(head) + size + len(tail)),
+        }
+        total_timeout = upload_timeout(size)
+
+        async def post(timeout: float) -> Any:
+            await self.rate_limiter.acquire()
+            with UPLOAD_SECONDS.time():
+                resp = await self.http.post(
+                    self.upload_url,
+                    params=upload_params,
+                    content=body(),
+                    headers=headers,
+                    timeout=httpx.Timeout(UPLOAD_TIMEOUT, read=timeout),
+                )
+            await reporter.update(stats["sent"], final=True)
+            resp.raise_for_status()
+            data = resp.json()
+            if isinstance(data, dict) and "exception" in data:
+                raise MoodleError("upload", data)
+            return data
+
+        try:
+            # The body is streamed once, an upload is never repeated
+            data = await self.policy.guarded("upload", post, total_timeout)
+        except Exception as e:
+            MOODLE_ERRORS.inc(wsfunction="upload", kind=error_kind(e))
+            raise
+        finally:
+            # A failed upload stops reading, release the file (or the ZIP writer) right away
+            await chunks.aclose()
+        UPLOAD_BYTES.inc(stats["sent"])
+
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Uploaded {filename}: {stats['sent']} bytes in {elapsed:.1f}s "
+            f"({stats['sent'] / max(elapsed, 1e-6) / 1024:.0f} KiB/s), sha1={sha1.hexdigest()}"
+        )
+        return UploadResult(response=data, sha1=sha1.hexdigest(), size=stats["sent"], elapsed=elapsed)
+
+    async def download_sha1(self, fileurl: str) -> str:
+        """Streams a Moodle pluginfile URL and returns its SHA-1 without keeping it in memory."""
+        async def fetch(timeout: float) -> str:
+            sha1 = hashlib.sha1()
+            await self.rate_limiter.acquire()
+            with MOODLE_CALL_SECONDS.time(wsfunction="pluginfile"):
+                async with self.http.stream("GET", fileurl, params={"token": self.token}, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    async for chunk in resp.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                        sha1.update(chunk)
+            return sha1.hexdigest()
+
+        try:
+            # Safe to retry, but not hedged: its duration depends on the file size
+            return await self.policy.read("pluginfile", fetch, UPLOAD_TIMEOUT, hedge=False)
+        except Exception as e:
+            MOODLE_ERRORS.inc(wsfunction="pluginfile", kind=error_kind(e))
+            raise
+
+    async def aclose(self):
+        self._closed = True
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Client of the tenant being served (see tenants.py). Unset = the process-wide client.
+_current_client: ContextVar = state.keep("moodle_client.current", lambda: ContextVar("moodle_client", default=None))
+
+
+@contextmanager
+def use_client(client: MoodleClient):
+    """get_client() returns `client` inside this block (and in tasks started from it)."""
+    token = _current_client.set(client)
+    try:
+        yield client
+    finally:
+        _current_client.reset(token)
+
+
+def get_client() -> MoodleClient:
+    """
+    Returns the MoodleClient of the tenant being served, otherwise the process-wide one
+    shared by server.py and webhook.py (kept across hot reloads).
+    """
+    client = _current_client.get()
+    if client is not None:
+        return client
+    client = state.get("moodle_client")
+    if client is None:
+        client = state.put("moodle_client", MoodleClient())
+    return client
+
+
+async def close_client():
+    client = state.pop("moodle_client")
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,295 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+import metrics
+import state
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# Reads that fail fast (refused connection, 5xx, 429) are retried this many times within their budget.
+# A slow read is never cut short to retry it: every attempt may use what is left of the budget,
+# slowness is what hedging is for.
+READ_RETRIES = int(os.getenv("MOODLE_READ_RETRIES", 2))
+# Full-jitter exponential backoff between attempts: uniform(0, min(cap, base * 2^n)) seconds
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 2.0
+
+# A read still running after its p95 gets one duplicate request, the first answer wins.
+# Hedges are capped to a share of all reads so a slow LMS isn't hit twice as hard.
+MOODLE_HEDGING = os.getenv("MOODLE_HEDGING", "1") == "1"
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_RATIO = 0.1
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+# After this many consecutive failures (network errors, timeouts, 5xx) calls fail fast for
+# CIRCUIT_OPEN_SECONDS, then a single probe decides whether the LMS is back
+CIRCUIT_FAILURES = int(os.getenv("MOODLE_CIRCUIT_FAILURES", 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("MOODLE_CIRCUIT_OPEN_SECONDS", 30))
+
+RETRIES = metrics.counter("smartsubmit_moodle_retries_total", "Moodle read attempts that were retried.", ["wsfunction"])
+HEDGES = metrics.counter(
+    "smartsubmit_moodle_hedges_total", "Duplicate requests sent for slow Moodle reads, by which one answered.",
+    ["wsfunction", "winner"],
+)
+CIRCUIT_TRANSITIONS = metrics.counter(
+    "smartsubmit_moodle_circuit_transitions_total", "Circuit breaker state changes.", ["state"]
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an LMS that is known to be down."""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"LMS unavailable, not calling it for another {retry_after:.0f}s")
+
+
+def is_transient(e: BaseException) -> bool:
+    """Failures worth retrying: the network, a timeout, an overloaded or failing server."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def never_sent(e: BaseException) -> bool:
+    """The request provably never reached the server, so even a write can be repeated."""
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def is_fast_failure(e: BaseException) -> bool:
+    """Transient failures that came back quickly, so a retry doesn't pile onto a slow server."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return never_sent(e) and not isinstance(e, httpx.TimeoutException)
+
+
+def is_timeout(e: BaseException) -> bool:
+    return isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError))
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies for one wsfunction."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: deque = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self._samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through. open: calls fail fast until `open_seconds` have passed.
+    half-open: one probe call goes through, its outcome closes or re-opens the circuit.
+    allow() hands the probe a token. Only that token frees the probe slot again, so a call
+    that started before the circuit opened can't let a second probe through.
+    """
+
+    def __init__(self, failures: int = CIRCUIT_FAILURES, open_seconds: float = CIRCUIT_OPEN_SECONDS):
+        self.failure_threshold = failures
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe: Optional[int] = None  # token of the running half-open probe
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> Optional[int]:
+        """
+        Raises CircuitOpenError unless a call may go out now.
+        Returns a probe token when this call is the half-open probe, None otherwise.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return None
+            waited = time.monotonic() - self._opened_at
+            if self.state == "open" and waited >= self.open_seconds:
+                self._set("half_open")
+            if self.state == "half_open" and self._probe is None:
+                self._probes += 1
+                self._probe = self._probes
+                return self._probe
+            raise CircuitOpenError(max(self.open_seconds - waited, 0.0))
+
+    def record_success(self, probe: Optional[int] = None):
+        with self._lock:
+            self._failures = 0
+            self._end_probe(probe)
+            if self.state != "closed":
+                self._set("closed")
+
+    def record_failure(self, probe: Optional[int] = None):
+        with self._lock:
+            self._failures += 1
+            self._end_probe(probe)
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._set("open")
+
+    def release(self, probe: Optional[int] = None):
+        """The call ended without telling anything about the LMS (e.g. it was cancelled)."""
+        with self._lock:
+            self._end_probe(probe)
+
+    def _end_probe(self, probe: Optional[int]):
+        if probe is not None and probe == self._probe:
+            self._probe = None
+
+    def _set(self, new_state: str):
+        logger.warning(f"Moodle circuit breaker: {self.state} -> {new_state}")
+        self.state = new_state
+        # A new state starts without a probe, a late answer from an old one must not free the slot
+        self._probe = None
+        CIRCUIT_TRANSITIONS.inc(state=new_state)
+
+
+class HostPolicy:
+    """
+    Resilience state of one LMS host, shared by every client (and tenant) talking to it:
+    the circuit breaker and per-wsfunction latencies that drive timeouts and hedging.
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self._latency: Dict[str, LatencyTracker] = {}
+        self._reads = 0
+        self._hedges = 0
+
+    def latency(self, wsfunction: str) -> LatencyTracker:
+        tracker = self._latency.get(wsfunction)
+        if tracker is None:
+            tracker = self._latency[wsfunction] = LatencyTracker()
+        return tracker
+
+    async def guarded(
+        self, wsfunction: str, fn: Callable[[float], Awaitable[T]], timeout: float, timeouts_fail: bool = True
+    ) -> T:
+        """
+        One request through the breaker, bounded by `timeout`, never repeated (e.g. an upload,
+        whose body can only be streamed once). Successful latencies are recorded.
+        With timeouts_fail=False running out of time says nothing about the LMS (a hedge
+        racing the original request), so it doesn't count as a breaker failure.
+        """
+        probe = self.breaker.allow()
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(timeout), timeout)
+        except asyncio.CancelledError:
+            self.breaker.release(probe)
+            raise
+        except Exception as e:
+            if is_timeout(e) and not timeouts_fail:
+                self.breaker.release(probe)
+            elif is_transient(e):
+                self.breaker.record_failure(probe)
+            else:
+                # Moodle answered (e.g. with an exception payload), so it is up
+                self.breaker.record_success(probe)
+            raise
+        self.breaker.record_success(probe)
+        self.latency(wsfunction).observe(time.monotonic() - started)
+        return result
+
+    async def once(self, wsfunction: str, fn: Callable[[float], Awaitable[T]], budget: float) -> T:
+        """
+        Non-idempotent calls (save, submit, upload): no hedging and no retry once the request
+        may have reached Moodle. Only a connection that was never made is tried again.
+        """
+        deadline = time.monotonic() + budget
+        for attempt in range(READ_RETRIES + 1):
+            try:
+                return await self.guarded(wsfunction, fn, max(deadline - time.monotonic(), 0.001))
+            except Exception as e:
+                if not never_sent(e) or attempt == READ_RETRIES or not await self._backoff(attempt, deadline):
+                    raise
+                RETRIES.inc(wsfunction=wsfunction)
+                logger.info(f"{wsfunction}: could not connect ({e!r}), trying again")
+
+    async def read(
+        self, wsfunction: str, fn: Callable[[float], Awaitable[T]], budget: float, hedge: bool = True
+    ) -> T:
+        """
+        Idempotent calls: hedged when slower than usual and retried with jittered backoff when
+        they fail fast, all within `budget` seconds. fn(timeout) performs one request.
+        """
+        deadline = time.monotonic() + budget
+        attempts = READ_RETRIES + 1
+        for attempt in range(attempts):
+            p95 = self.latency(wsfunction).p95() if hedge else None
+            try:
+                return await self._hedged(wsfunction, fn, max(deadline - time.monotonic(), 0.001), p95)
+            except Exception as e:
+                if not is_fast_failure(e) or attempt == attempts - 1 or not await self._backoff(attempt, deadline):
+                    raise
+                RETRIES.inc(wsfunction=wsfunction)
+                logger.info(f"{wsfunction}: attempt {attempt + 1} failed ({e!r}), retrying")
+
+    async def _backoff(self, attempt: int, deadline: float) -> bool:
+        """Sleeps before the next attempt. False if the budget doesn't allow one."""
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    async def _hedged(
+        self, wsfunction: str, fn: Callable[[float], Awaitable[T]], timeout: float, p95: Optional[float]
+    ) -> T:
+        self._reads += 1
+        delay = max(p95, HEDGE_MIN_DELAY) if p95 is not None else None
+        if not MOODLE_HEDGING or delay is None or delay >= timeout:
+            return await self.guarded(wsfunction, fn, timeout)
+
+        first = asyncio.ensure_future(self.guarded(wsfunction, fn, timeout))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if not done and self._hedges < HEDGE_MAX_RATIO * self._reads and self.breaker.state == "closed":
+                self._hedges += 1
+                hedge = asyncio.ensure_future(self.guarded(wsfunction, fn, timeout - delay, timeouts_fail=False))
+            # Both requests end on their own timeout, no extra deadline needed here
+            pending = {first, hedge} - {None}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedge is not None:
+                            HEDGES.inc(wsfunction=wsfunction, winner="hedge" if task is hedge else "original")
+                        return task.result()
+                    error = task.exception()
+                    if not is_transient(error):
+                        raise error
+            raise error
+        finally:
+            for task in (first, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+
+def for_host(url: Optional[str]) -> HostPolicy:
+    """The policy of the host behind a Moodle URL (kept across hot reloads)."""
+    policies = state.keep("resilience.hosts", dict)
+    host = httpx.URL(url).host if url else ""
+    policy = policies.get(host)
+    if policy is None:
+        policy = policies[host] = HostPolicy()
+    return policy
@@ -0,0 +1,128 @@
+import json
+import secrets
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Tuple
+
+from cache import TTLCache
+import state
+
+# Full result sets are kept this long (seconds) so follow-up pages need no LMS fetch or disk scan
+RESULT_SET_TTL = 600.0
+# At most this many results are kept per query (and reachable through cursors)
+MAX_RESULTS = 500
+
+FORMATS = ("text", "json")
+
+_result_sets: TTLCache = state.keep("results.sets", lambda: TTLCache(max_size=64, default_ttl=RESULT_SET_TTL))
+
+
+class CursorError(ValueError):
+    """Unknown, expired or mismatched pagination cursor."""
+
+
+@dataclass(slots=True)
+class DeadlineItem:
+    name: str
+    course: str
+    course_id: Optional[int]
+    assignment_id: Optional[int]  # instance id (what mod_assign_* functions take)
+    cmid: Optional[int]           # course module id (what the Moodle URL shows)
+    due: int                      # unix timestamp
+    due_text: str
+
+    def text(self) -> str:
+        assign_id = self.assignment_id if self.assignment_id is not None else "N/A"
+        id_str = f"ID: {assign_id}, CMID: {self.cmid}" if self.cmid else f"ID: {assign_id}"
+        return f"- {self.name} ({self.course}) [{id_str}]: Due {self.due_text}"
+
+
+@dataclass(slots=True)
+class FileItem:
+    path: str
+    name: str
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+    score: Optional[float] = None
+
+    def text(self) -> str:
+        # Full paths so the agent can submit them directly
+        return self.path
+
+
+@dataclass(slots=True)
+class Page:
+    kind: str              # "deadlines" or "files", cursors only continue the same kind
+    items: list
+    title: str             # text header, e.g. "Upcoming Moodle Deadlines"
+    total: Optional[int]   # matches overall, None when unknown (fetch stopped early)
+    offset: int = 0
+    cursor: Optional[str] = None
+    notes: List[str] = field(default_factory=list)
+    empty: str = "No results."  # text shown instead of an empty list
+
+    def render(self, format: str = "text") -> str:
+        if format == "json":
+            data = {
+                "items": [{k: v for k, v in asdict(item).items() if v is not None} for item in self.items],
+                "total": self.total,
+                "offset": self.offset,
+                "next_cursor": self.cursor,
+            }
+            if self.notes:
+                data["notes"] = self.notes
+            return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+        if not self.items:
+            return "\n".join([self.empty] + self.notes)
+        header = self.title
+        shown = len(self.items)
+        if self.cursor or self.offset:
+            of_total = f" of {self.total}" if self.total is not None else ""
+            header += f", showing {self.offset + 1}-{self.offset + shown}{of_total}"
+        lines = [f"{header}:"] + [item.text() for item in self.items]
+        if self.cursor:
+            lines.append(f"(More results available: cursor='{self.cursor}')")
+        lines.extend(self.notes)
+        return "\n".join(lines)
+
+
+def paginate(
+    kind: str,
+    items: list,
+    title: str,
+    limit: Optional[int],
+    total: Optional[int] = None,
+    notes: Optional[List[str]] = None,
+) -> Page:
+    """First page of a result set. The rest is cached and reachable through the returned cursor."""
+    total = len(items) if total is None else total
+    items = items[:MAX_RESULTS]
+    notes = list(notes or [])
+    if total > len(items):
+        notes.append(f"(Only the first {len(items)} of {total} results can be paged through, narrow the query to see others)")
+    if not limit or len(items) <= limit:
+        return Page(kind, items, title, total, notes=notes)
+    token = secrets.token_urlsafe(6)
+    _result_sets.set(token, (kind, items, title, total, notes))
+    return Page(kind, items[:limit], title, total, 0, f"{token}.{limit}", notes)
+
+
+def next_page(kind: str, cursor: str, limit: Optional[int]) -> Page:
+    """The page starting at the cursor, served from the cached result set."""
+    token, offset = _parse_cursor(cursor)
+    stored = _result_sets.get(token)
+    if stored is None:
+        raise CursorError("This cursor has expired. Run the query again without a cursor.")
+    stored_kind, items, title, total, notes = stored
+    if stored_kind != kind:
+        raise CursorError(f"This cursor belongs to a {stored_kind} listing, not {kind}.")
+    end = offset + limit if limit else len(items)
+    cursor = f"{token}.{end}" if end < len(items) else None
+    return Page(kind, items[offset:end], title, total, offset, cursor, notes)
+
+
+def _parse_cursor(cursor: str) -> Tuple[str, int]:
+    token, _, offset = cursor.rpartition(".")
+    if not token or not offset.isdigit():
+        raise CursorError(f"Invalid cursor '{cursor}'.")
+    return token, int(offset)
@@ -0,0 +1,177 @@
+import os
+import re
+import math
+import time
+import heapq
+import bisect
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Word boundaries inside a filename: separators, camelCase humps, letter<->digit switches.
+# "AHMED_LAB_03_BDA.zip" -> ahmed lab 3 bda,  "LabReport3" -> lab report 3
+_SEPARATORS = re.compile(r"[^0-9A-Za-z]+")
+_WORDS = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+# Relative weights of the ways a query token can match a filename token
+EXACT_SCORE = 1.0
+ACRONYM_SCORE = 0.9
+PREFIX_SCORE = 0.8
+FUZZY_SCORE = 0.7
+FUZZY_MIN_SIMILARITY = 0.25
+
+# Newer files win ties. Bonus decays with a ~30 day half life.
+RECENCY_WEIGHT = 0.15
+RECENCY_HALF_LIFE_DAYS = 30.0
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased filename tokens with zero padding stripped from numbers."""
+    tokens = []
+    for chunk in _SEPARATORS.split(text):
+        for word in _WORDS.findall(chunk):
+            if word.isdigit():
+                word = str(int(word))
+            tokens.append(word.lower())
+    return tokens
+
+
+def _trigrams(token: str) -> Set[str]:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _acronyms(tokens: List[str]) -> Set[str]:
+    """Initials of consecutive word runs, e.g. big data analytics -> bd, bda, da."""
+    found = set()
+    run = []
+    for token in tokens + ["0"]:
+        if token.isalpha():
+            run.append(token[0])
+            continue
+        initials = "".join(run)
+        for i in range(len(initials)):
+            for j in range(i + 2, len(initials) + 1):
+                found.add(initials[i:j])
+        run = []
+    return found
+
+
+class SearchIndex:
+    """
+    Precomputed inverted + trigram index over filenames.
+    Built once per file-index generation, queries only touch matching documents.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, str, float]]):
+        # entries: (path, filename, mtime)
+        self.paths: List[str] = []
+        self.mtimes: List[float] = []
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        self.acronym_postings: Dict[str, Set[int]] = defaultdict(set)
+
+        for doc_id, (path, name, mtime) in enumerate(entries):
+            self.paths.append(path)
+            self.mtimes.append(mtime or 0.0)
+            tokens = tokenize(os.path.splitext(name)[0])
+            for token in tokens:
+                self.postings[token].add(doc_id)
+            for acronym in _acronyms(tokens):
+                self.acronym_postings[acronym].add(doc_id)
+
+        self._memo: Dict[str, Dict[int, float]] = {}
+
+        # Vocabulary structures for prefix (bisect) and fuzzy (trigram) lookups
+        self.vocab = sorted(self.postings)
+        self.trigram_postings: Dict[str, Set[str]] = defaultdict(set)
+        for token in self.vocab:
+            if not token.isdigit():
+                for gram in _trigrams(token):
+                    self.trigram_postings[gram].add(token)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _token_matches(self, q: str) -> Dict[int, float]:
+        """Best score per document for a single query token (memoized per index)."""
+        scores = self._memo.get(q)
+        if scores is None:
+            scores = self._compute_token_matches(q)
+            if len(self._memo) >= 512:
+                self._memo.clear()
+            self._memo[q] = scores
+        return scores
+
+    def _compute_token_matches(self, q: str) -> Dict[int, float]:
+        scores: Dict[int, float] = {}
+
+        def add(doc_ids: Set[int], score: float):
+            for d in doc_ids:
+                if score > scores.get(d, 0.0):
+                    scores[d] = score
+
+        add(self.postings.get(q, set()), EXACT_SCORE)
+        # Numbers only match exactly: "lab 3" must not find "lab 13"
+        if q.isdigit():
+            return scores
+
+        add(self.acronym_postings.get(q, set()), ACRONYM_SCORE)
+
+        # Prefix / abbreviation: "comp" -> "compiler"
+        i = bisect.bisect_left(self.vocab, q)
+        while i < len(self.vocab) and self.vocab[i].startswith(q):
+            token = self.vocab[i]
+            if token != q:
+                add(self.postings[token], PREFIX_SCORE * (0.5 + 0.5 * len(q) / len(token)))
+            i += 1
+
+        # Typos / spelling variants via trigram Jaccard similarity
+        if len(q) >= 3:
+            q_grams = _trigrams(q)
+            shared: Dict[str, int] = defaultdict(int)
+            for gram in q_grams:
+                for token in self.trigram_postings.get(gram, ()):
+                    shared[token] += 1
+            for token, common in shared.items():
+                similarity = common / (len(q_grams) + len(_trigrams(token)) - common)
+                if similarity >= FUZZY_MIN_SIMILARITY and token != q:
+                    add(self.postings[token], FUZZY_SCORE * similarity)
+        return scores
+
+    def search(
+        self, query: str, top_k: int = 20, now: Optional[float] = None
+    ) -> Tuple[List[Tuple[str, float]], int]:
+        """
+        Returns (up to top_k (path, score) pairs best first, total number of matches).
+        Every number in the query must match, and all but a third of the query tokens overall
+        (so filler words like "find" or "the" in "find the BDA lab" do not sink a result).
+        """
+        q_tokens = list(dict.fromkeys(tokenize(query)))
+        if not q_tokens:
+            return [], 0
+
+        per_token = [self._token_matches(q) for q in q_tokens]
+        required = [m for q, m in zip(q_tokens, per_token) if q.isdigit()]
+        min_hits = len(q_tokens) - len(q_tokens) // 3
+
+        # A document may miss at most `slack` tokens, so it must appear in at least one
+        # of the slack+1 smallest match sets. Start from those instead of the full union.
+        slack = len(q_tokens) - min_hits
+        candidates: Set[int] = set()
+        for m in sorted(per_token, key=len)[:slack + 1]:
+            candidates.update(m)
+        for m in sorted(required, key=len):
+            candidates.intersection_update(m)
+
+        now = now if now is not None else time.time()
+        decay = math.log(2) / (RECENCY_HALF_LIFE_DAYS * 86400)
+        scored = []
+        for d in candidates:
+            hits = [m[d] for m in per_token if d in m]
+            if len(hits) < min_hits:
+                continue
+            relevance = sum(hits) / len(q_tokens)
+            age = max(0.0, now - self.mtimes[d])
+            scored.append((relevance + RECENCY_WEIGHT * math.exp(-decay * age), d))
+
+        top = heapq.nlargest(top_k, scored)
+        return [(self.paths[d], round(score, 3)) for score, d in top], len(scored)
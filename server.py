@@ -1,10 +1,43 @@
-import os
+import sys
+import time
 import logging
-from fastmcp import FastMCP
-from services import list_lab_files, check_deadlines, submit_to_lms
+import importlib
+from contextlib import asynccontextmanager
+from fastmcp import FastMCP, Context
+import mcp_tools
+import state
+
+# Modules re-imported by restart_agent(mode="reload"), dependencies first.
+# state.py is never reloaded: it holds the caches and connections carried across.
+RELOADABLE_MODULES = [
+    "metrics",
+    "cache",
+    "assignments",
+    "file_index",
+    "search",
+    "jobs",
+    "fs",
+    "resilience",
+    "moodle_client",
+    "tenants",
+    "deadline_sync",
+    "results",
+    "tools",
+    "mcp_tools",
+]
+
+@asynccontextmanager
+async def lifespan(server):
+    # Keep a warm local copy of upcoming deadlines while the agent is connected
+    import deadline_sync
+    await deadline_sync.start_engine()
+    try:
+        yield
+    finally:
+        await deadline_sync.stop_engine()
 
 # Initialize FastMCP Server
-mcp = FastMCP("SmartSubmit")
+mcp = FastMCP("SmartSubmit", lifespan=lifespan)
 
 # Setup Logging (Redirect to file to avoid stdout pollution interfering with MCP)
 logging.basicConfig(
@@ -13,44 +46,107 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-@mcp.tool()
-async def list_documents(directory: str = None, query: str = None) -> str:
+# Tools live in mcp_tools.py so a hot reload can register their new versions
+_tool_names = mcp_tools.register(mcp)
+
+
+def _upgrade_instances(modules: list):
     """
-    REQUIRED: Use this tool to list files on the USER'S local computer. 
-    Do NOT check /mnt/ or cloud paths. 
-    Lists documents (PDF, Word, Excel, ZIP) from the configured local directory.
-    Use 'query' to filter by name (e.g. 'Lab 1', 'Financial Report').
+    Points kept objects (and the objects they hold) at the reloaded version of their class,
+    so e.g. the pooled MoodleClient runs the new code without losing its connections.
     """
-    target_dir = directory or os.getenv("LAB_DIRECTORY", "E:\\Downloads")
-    
-    if not os.path.exists(target_dir):
-        # Fallback if preferred dir is missing
-        fallback = os.path.expanduser("~/Downloads")
-        if os.path.exists(fallback):
-            return await list_lab_files(fallback, query) + f"\n(Note: Could not find {target_dir}, listing from {fallback} instead)"
-        return f"Error: Could not find directory {target_dir} or {fallback}"
+    seen = set()
 
-    return await list_lab_files(target_dir, query)
+    def upgrade(obj, depth: int):
+        if depth < 0 or id(obj) in seen:
+            return
+        seen.add(id(obj))
+        cls = type(obj)
+        if cls.__module__ in modules:
+            new_cls = getattr(sys.modules[cls.__module__], cls.__qualname__, None)
+            if isinstance(new_cls, type) and new_cls is not cls:
+                try:
+                    obj.__class__ = new_cls
+                except TypeError as e:
+                    logging.warning(f"Hot reload: {cls.__qualname__} instance keeps its old code ({e})")
+            children = vars(obj).values() if hasattr(obj, "__dict__") else ()
+        elif isinstance(obj, dict):
+            children = obj.values()
+        elif isinstance(obj, (list, tuple, set)):
+            children = obj
+        else:
+            return
+        for child in list(children):
+            upgrade(child, depth - 1)
 
-@mcp.tool()
-async def check_my_deadlines(search_query: str = None) -> str:
-    """REQUIRED: Connects to the User's Real LMS (Moodle) to fetch actual upcoming assignments and deadlines."""
-    return await check_deadlines(search_query)
+    for obj in state.objects().values():
+        upgrade(obj, 3)
+
+
+async def hot_reload() -> list:
+    """
+    Re-imports the agent's modules in place and re-registers the MCP tools.
+    Everything kept in state.py (HTTP pool, metadata cache, file index, metrics) survives.
+    Sources are compiled first, a syntax error aborts before anything is replaced.
+    """
+    global _tool_names
+    loaded = [name for name in RELOADABLE_MODULES if name in sys.modules]
+    for name in loaded:
+        path = sys.modules[name].__file__
+        with open(path, "r", encoding="utf-8") as f:
+            compile(f.read(), path, "exec")
+
+    for name in loaded:
+        importlib.reload(sys.modules[name])
+    _upgrade_instances(loaded)
+
+    for name in _tool_names:
+        mcp.local_provider.remove_tool(name)
+    _tool_names = sys.modules["mcp_tools"].register(mcp)
+
+    # The sync loop keeps running the code it started with, restart it on the new one
+    if "deadline_sync" in loaded:
+        engine = sys.modules["deadline_sync"].current_engine()
+        if engine is not None:
+            await engine.stop()
+            engine.start()
+    return loaded
 
-@mcp.tool()
-async def submit_assignment(assignment_id: str, file_path: str) -> str:
-    """Uploads a specific file to a specific assignment ID."""
-    return await submit_to_lms(assignment_id, file_path)
 
 @mcp.tool()
-def restart_agent() -> str:
+async def restart_agent(mode: str = "reload", ctx: Context = None) -> str:
     """
-    Restart the agent to apply code changes. 
-    This will Disconnect the agent. You must click 'Retry Connection' in the Claude Desktop interface immediately after.
+    Restart the agent to apply code changes.
+    mode="reload" (default): reloads the code in place within milliseconds. Caches and the LMS
+    connection are kept and the agent stays connected.
+    mode="exit": stops the process for a full restart. This will Disconnect the agent. You must click
+    'Retry Connection' in the Claude Desktop interface immediately after. Only use it if a reload failed.
     """
-    logging.info("Restarting agent requested by user...")
-    sys.exit(0)
-    return "Restarting..."
+    if mode == "exit":
+        logging.info("Restarting agent requested by user...")
+        sys.exit(0)
+        return "Restarting..."
+
+    logging.info("Hot reload requested by user...")
+    started = time.perf_counter()
+    try:
+        reloaded = await hot_reload()
+    except SyntaxError as e:
+        logging.error(f"Hot reload aborted: {e}")
+        return f"Reload aborted, nothing was changed: {e}. Fix the code and try again."
+    except Exception as e:
+        logging.error(f"Hot reload failed: {repr(e)}")
+        return f"Reload failed: {repr(e)}. Fix the code and reload again, or use mode='exit' for a full restart."
+    elapsed = time.perf_counter() - started
+
+    if ctx is not None:
+        try:
+            from mcp.types import ToolListChangedNotification
+            await ctx.send_notification(ToolListChangedNotification())
+        except Exception as e:
+            logging.warning(f"Could not notify the client about the new tool list: {e}")
+    logging.info(f"Hot reload done in {elapsed * 1000:.0f} ms: {', '.join(reloaded)}")
+    return f"Reloaded {len(reloaded)} modules in {elapsed * 1000:.0f} ms. Caches and connections were kept, no reconnect needed."
 
 if __name__ == "__main__":
     mcp.run()
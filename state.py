@@ -0,0 +1,38 @@
+"""
+Process-wide objects that must survive a hot reload (restart_agent mode="reload").
+
+Modules keep their long-lived state (HTTP pools, caches, the file index, metrics) here
+instead of in plain module globals. importlib.reload() re-runs a module's top level,
+so `x = state.keep("module.x", factory)` hands the existing object back instead of a
+cold one. This module is never reloaded itself.
+"""
+from typing import Any, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+_objects: Dict[str, Any] = {}
+
+
+def keep(name: str, factory: Callable[[], T]) -> T:
+    """Returns the object stored under name, creating it with factory() the first time."""
+    if name not in _objects:
+        _objects[name] = factory()
+    return _objects[name]
+
+
+def get(name: str, default: Any = None) -> Any:
+    return _objects.get(name, default)
+
+
+def put(name: str, value: T) -> T:
+    _objects[name] = value
+    return value
+
+
+def pop(name: str, default: Any = None) -> Any:
+    return _objects.pop(name, default)
+
+
+def objects() -> Dict[str, Any]:
+    """Snapshot of everything kept, used by the reloader to upgrade instances to reloaded classes."""
+    return dict(_objects)
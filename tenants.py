@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from dotenv import load_dotenv
+
+from cache import TTLCache
+from moodle_client import MOODLE_URL, MoodleClient, use_client
+import fs
+import state
+
+load_dotenv()
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# JSON file mapping WhatsApp numbers to their own Moodle account, e.g.
+# {"+923001234567": {"token": "...", "lab_directory": "D:\\Labs", "url": "https://.../server.php"}}
+# ("url" is optional, MOODLE_URL is used otherwise). Unset = single user via WHATSAPP_ALLOWED_NUMBER.
+# The file is re-read when it changes, adding a student needs no restart.
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+# Tenants with a live connection pool and caches. The least recently used idle one is evicted beyond this.
+MAX_ACTIVE_TENANTS = int(os.getenv("MAX_ACTIVE_TENANTS", 100))
+# Tenants idle for this long (seconds) are evicted too, their next message starts them again
+TENANT_IDLE_TTL = float(os.getenv("TENANT_IDLE_TTL", 1800))
+# Per-tenant LMS budget: requests per second and pooled connections
+TENANT_RATE_LIMIT = float(os.getenv("TENANT_RATE_LIMIT", 2))
+TENANT_MAX_CONNECTIONS = int(os.getenv("TENANT_MAX_CONNECTIONS", 4))
+TENANT_CACHE_SIZE = 32
+
+
+def normalize_number(number: str) -> str:
+    """'whatsapp:+92 300 1234567' -> '+923001234567'"""
+    number = number.strip()
+    if number.startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    return number.replace(" ", "").replace("-", "")
+
+
+@dataclass(frozen=True)
+class TenantConfig:
+    number: str
+    token: str
+    lab_directory: Optional[str] = None
+    url: Optional[str] = None
+
+
+@dataclass
+class Tenant:
+    """One user's Moodle connection and caches. Nothing in here is shared with other tenants."""
+
+    config: TenantConfig
+    client: MoodleClient
+    metadata_cache: TTLCache
+    assignment_indexes: dict = field(default_factory=dict)
+    last_used: float = field(default_factory=time.monotonic)
+    busy: int = 0  # jobs queued or running (see hold), a busy tenant is never evicted
+    retired: bool = False  # replaced by a config change while busy, closed once its last request ends
+
+    @property
+    def number(self) -> str:
+        return self.config.number
+
+    @property
+    def lab_directory(self) -> Optional[str]:
+        return self.config.lab_directory
+
+    def hold(self):
+        """Keeps the tenant from being evicted until release(), e.g. while its job waits in the queue."""
+        self.busy += 1
+
+    async def release(self):
+        self.busy -= 1
+        self.last_used = time.monotonic()
+        if self.retired and not self.busy:
+            await self.client.aclose()
+            logger.info(f"Retired tenant {self.number} closed.")
+
+    @classmethod
+    def start(cls, config: TenantConfig) -> "Tenant":
+        client = MoodleClient(
+            token=config.token,
+            url=config.url or MOODLE_URL,
+            max_connections=TENANT_MAX_CONNECTIONS,
+            max_keepalive=TENANT_MAX_CONNECTIONS,
+            rate_limit=TENANT_RATE_LIMIT,
+        )
+        # In memory only: one shared cache file for hundreds of tenants would be rewritten constantly
+        return cls(config, client, TTLCache(max_size=TENANT_CACHE_SIZE, default_ttl=3600.0))
+
+
+# Tenant being served by the current request (and the tasks it starts)
+_current: ContextVar = state.keep("tenants.current", lambda: ContextVar("tenant", default=None))
+
+
+def current() -> Optional[Tenant]:
+    return _current.get()
+
+
+@contextmanager
+def activate(tenant: Tenant):
+    """Routes get_client() and the tools' caches to this tenant inside the block."""
+    token = _current.set(tenant)
+    try:
+        with use_client(tenant.client):
+            yield tenant
+    finally:
+        _current.reset(token)
+
+
+class TenantRegistry:
+    """
+    Maps sender numbers to tenants, started on their first message.
+    Active tenants are kept in LRU order and bounded by max_active / idle_ttl,
+    an evicted tenant's connection pool is closed and its caches dropped.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        max_active: int = MAX_ACTIVE_TENANTS,
+        idle_ttl: float = TENANT_IDLE_TTL,
+    ):
+        self.path = path
+        self.max_active = max_active
+        self.idle_ttl = idle_ttl
+        self._configs: Dict[str, TenantConfig] = {}
+        self._mtime: Optional[float] = None
+        self._active: "OrderedDict[str, Tenant]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    def _read(self) -> Dict[str, TenantConfig]:
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        configs = {}
+        for number, entry in data.items():
+            if not isinstance(entry, dict) or not entry.get("token"):
+                logger.warning(f"Tenant {number} has no token, skipped.")
+                continue
+            number = normalize_number(number)
+            configs[number] = TenantConfig(
+                number=number,
+                token=entry["token"],
+                lab_directory=entry.get("lab_directory"),
+                url=entry.get("url"),
+            )
+        return configs
+
+    async def _reload_if_changed(self):
+        try:
+            mtime = (await fs.stat(self.path)).st_mtime
+        except (OSError, asyncio.TimeoutError) as e:
+            if self._mtime is None:
+                logger.error(f"Could not read TENANTS_FILE {self.path}: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            configs = await fs.run(self._read)
+        except (OSError, ValueError) as e:
+            # Keep serving the last good configuration while the file is being edited
+            logger.error(f"Invalid TENANTS_FILE {self.path}: {e}")
+            return
+        self._configs, self._mtime = configs, mtime
+        logger.info(f"Loaded {len(configs)} tenants from {self.path}.")
+        # Removed tenants and changed tokens must not keep their old client. A busy one is
+        # retired instead: new messages start a fresh tenant, the running job keeps its client.
+        for number, tenant in list(self._active.items()):
+            if configs.get(number) != tenant.config:
+                if tenant.busy:
+                    self._active.pop(number)
+                    tenant.retired = True
+                    logger.info(f"Tenant {number} changed, closing it when its running jobs end.")
+                else:
+                    await self._evict(number)
+
+    async def resolve(self, sender: str) -> Optional[Tenant]:
+        """The tenant for a sender ('whatsapp:+92...'), None if the number is not registered."""
+        await self._reload_if_changed()
+        number = normalize_number(sender)
+        config = self._configs.get(number)
+        if config is None:
+            return None
+        tenant = self._active.get(number)
+        if tenant is None:
+            tenant = self._active[number] = Tenant.start(config)
+            logger.info(f"Tenant {number} started ({len(self._active)} active).")
+        self._active.move_to_end(number)
+        tenant.last_used = time.monotonic()
+        await self._evict_idle()
+        return tenant
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        overflow = len(self._active) - self.max_active
+        # Oldest first, the tenant just resolved is at the end
+        for number, tenant in list(self._active.items())[:-1]:
+            if tenant.busy:
+                continue
+            if overflow > 0 or now - tenant.last_used > self.idle_ttl:
+                await self._evict(number)
+                overflow -= 1
+
+    async def _evict(self, number: str):
+        tenant = self._active.pop(number, None)
+        if tenant is not None:
+            await tenant.client.aclose()
+            logger.info(f"Tenant {number} evicted ({len(self._active)} active).")
+
+    async def run(self, tenant: Optional[Tenant], fn: Callable[[], Awaitable[T]], held: bool = False) -> T:
+        """
+        Runs fn() as `tenant` (plain fn() for None). The tenant can't be evicted meanwhile.
+        held=True takes over a hold() the caller already placed (a queued job), and releases it.
+        """
+        if tenant is None:
+            return await fn()
+        if not held:
+            tenant.hold()
+        try:
+            with activate(tenant):
+                return await fn()
+        finally:
+            await tenant.release()
+
+    async def aclose(self):
+        for number in list(self._active):
+            await self._evict(number)
+
+
+def get_registry() -> TenantRegistry:
+    """The process-wide registry for TENANTS_FILE (kept across hot reloads)."""
+    registry = state.get("tenants.registry")
+    if registry is None:
+        registry = state.put("tenants.registry", TenantRegistry(TENANTS_FILE))
+    return registry
+
+
+async def close_registry():
+    registry = state.pop("tenants.registry")
+    if registry is not None:
+        await registry.aclose()
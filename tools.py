@@ -1,8 +1,28 @@
 import os
-import httpx
+import re
+import time
+import asyncio
+import heapq
+import hashlib
+import inspect
 import logging
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 from dotenv import load_dotenv
+from cache import SingleFlight, TTLCache
+from file_index import FileIndex
+from assignments import AssignmentIndex
+import deadline_sync
+from deadline_sync import iter_action_events
+from search import SearchIndex
+import metrics
+from moodle_client import get_client, MoodleClient, MoodleError, ProgressCallback, UPLOAD_CHUNK_SIZE
+import state
+import fs
+import resilience
+from resilience import CircuitOpenError
+import results
+import tenants
 
 # Load environment variables
 load_dotenv()
@@ -19,124 +39,542 @@ logger = logging.getLogger(__name__)
 MOODLE_TOKEN = os.getenv("MOODLE_TOKEN")
 MOODLE_URL = os.getenv("MOODLE_URL") # e.g. https://lms.nust.edu.pk/webservice/rest/server.php
 
-async def list_lab_files(directory: str, search_query: str = None) -> str:
-    """Lists available PDF/Word reports in a specific directory. Optional filter."""
-    logger.info(f"Scanning directory: {directory} for query: {search_query}")
+@dataclass
+class SubmissionResult:
+    """Outcome of one submission workflow. status: submitted | draft | already_submitted | uploaded | error"""
+    assignment_id: str
+    file_path: str
+    status: str
+    message: str
+    instance_id: Optional[str] = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("submitted", "already_submitted", "uploaded")
+
+
+# Parallel submission workflows in submit_batch_to_lms (the rate limit still applies on top)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+# --- METADATA CACHE ---
+# Site info (user id) and enrolled courses almost never change, so we keep them
+# around instead of paying two extra round trips on every deadline query.
+# Backed by a JSON file so a restarted MCP process starts warm.
+SITE_INFO_TTL = float(os.getenv("SITE_INFO_TTL", 24 * 3600))
+COURSES_TTL = float(os.getenv("COURSES_TTL", 6 * 3600))
+CACHE_FILE = os.getenv(
+    "SMARTSUBMIT_CACHE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".smartsubmit_cache.json"),
+)
+
+metadata_cache = state.keep(
+    "tools.metadata_cache",
+    lambda: TTLCache(max_size=128, default_ttl=COURSES_TTL, path=CACHE_FILE or None, autosave=False, load=False),
+)
+
+
+def _metadata() -> TTLCache:
+    # Each webhook tenant has its own cache, so one busy user can't evict everyone else's entries
+    tenant = tenants.current()
+    return tenant.metadata_cache if tenant is not None else metadata_cache
+
+
+async def _load_metadata() -> TTLCache:
+    """The metadata cache, its file read on the fs pool on first use (never on the event loop)."""
+    cache = _metadata()
+    if not cache.loaded:
+        try:
+            await _flights.do("tools.metadata_load", lambda: fs.run(cache.load))
+        except asyncio.TimeoutError:
+            logger.warning(f"Reading {cache.path} timed out, starting with a cold metadata cache.")
+    return cache
+
+
+def _persist_metadata():
+    """
+    Writes the metadata cache file on the fs pool after a change, never on the event loop.
+    One writer at a time, it keeps going while changes come in during a write.
+    """
+    cache = _metadata()
+    if not cache.dirty:
+        return
     try:
-        if not os.path.exists(directory):
-            logger.error(f"Directory not found: {directory}")
-            return f"Error: Directory '{directory}' does not exist."
-
-        # Filter extensions (PDF, Word, Excel, ZIP)
-        allowed_exts = ('.pdf', '.docx', '.doc', '.zip', '.xlsx', '.xls', '.csv')
-        all_files = [f for f in os.listdir(directory) if f.lower().endswith(allowed_exts)]
-        
-        # Filter by query if provided (Smart Token Matching)
+        asyncio.get_running_loop()
+    except RuntimeError:
+        cache.save()
+        return
+    writer = state.get("tools.metadata_writer")
+    if writer is not None and not writer.done():
+        return
+
+    async def write():
+        while cache.dirty:
+            try:
+                await fs.run(cache.save)
+            except asyncio.TimeoutError:
+                logger.warning(f"Writing {cache.path} timed out, it is retried on the next change.")
+                return
+    state.put("tools.metadata_writer", asyncio.create_task(write()))
+
+
+def _cache_key(client: MoodleClient, name: str) -> str:
+    # Keyed per token so switching accounts never serves someone else's data
+    return f"{client.fingerprint}:{name}"
+
+
+async def _stale_metadata(key: str, e: Exception):
+    """An expired cached value while the LMS is down, otherwise re-raises e."""
+    stale = _metadata().get_stale(key)
+    if stale is None or not (isinstance(e, CircuitOpenError) or resilience.is_transient(e)):
+        raise e
+    logger.warning(f"LMS unavailable ({repr(e)}), using expired cache entry {key.split(':', 1)[1]}.")
+    return stale
+
+
+async def get_site_info(client: MoodleClient) -> dict:
+    """core_webservice_get_site_info, cached for SITE_INFO_TTL (expired entries serve while the LMS is down)."""
+    key = _cache_key(client, "site_info")
+    site_info = (await _load_metadata()).get(key)
+    if site_info is None:
+        try:
+            site_info = await client.call("core_webservice_get_site_info")
+        except Exception as e:
+            return await _stale_metadata(key, e)
+        # The full response lists every web service function, keep only the identity fields
+        site_info = {k: site_info.get(k) for k in ("userid", "username", "fullname", "sitename", "siteurl")}
+        _metadata().set(key, site_info, ttl=SITE_INFO_TTL)
+        _persist_metadata()
+    return site_info
+
+
+async def get_course_map(client: MoodleClient, user_id: int) -> Dict[int, str]:
+    """Enrolled courses as {course_id: fullname}, cached for COURSES_TTL."""
+    key = _cache_key(client, f"courses:{user_id}")
+    courses_data = (await _load_metadata()).get(key)
+    if courses_data is None:
+        try:
+            courses_data = await client.call("core_enrol_get_users_courses", userid=user_id)
+        except Exception as e:
+            # Served as is, not stored again: it must not look fresh
+            courses_data = await _stale_metadata(key, e)
+        else:
+            if not isinstance(courses_data, list):
+                return {}
+            # Only keep what we use, the raw course objects are large
+            courses_data = [{"id": c.get("id"), "fullname": c.get("fullname")} for c in courses_data]
+            _metadata().set(key, courses_data, ttl=COURSES_TTL)
+            _persist_metadata()
+    # Create map: {61184: "Compiler Construction", ...}
+    return {c.get("id"): c.get("fullname") or "Unknown Course" for c in courses_data}
+
+
+# --- ASSIGNMENT ID RESOLUTION ---
+# One mod_assign_get_assignments call maps every cmid <-> instance id the user can see.
+ASSIGNMENTS_TTL = float(os.getenv("ASSIGNMENTS_TTL", 12 * 3600))
+# Unknown IDs trigger a refresh at most this often, typos must not hammer the LMS
+ASSIGNMENTS_MISS_REFRESH = 60.0
+
+_assignment_indexes: Dict[str, AssignmentIndex] = state.keep("tools.assignment_indexes", dict)
+
+
+def _indexes() -> Dict[str, AssignmentIndex]:
+    tenant = tenants.current()
+    return tenant.assignment_indexes if tenant is not None else _assignment_indexes
+
+# Identical concurrent LMS fetches (deadline queries, index refreshes) share one request
+_flights: SingleFlight = state.keep("tools.flights", SingleFlight)
+# Strong references to fire-and-forget tasks (asyncio only keeps weak ones)
+_background_tasks: set = state.keep("tools.background_tasks", set)
+
+
+def cached_assignment_index(client: MoodleClient) -> Optional[AssignmentIndex]:
+    """
+    The assignment index from memory or the metadata cache, without any network call.
+    Callers await _load_metadata() first, otherwise a stored index is not seen yet.
+    """
+    key = _cache_key(client, "assignments")
+    index = _indexes().get(key)
+    if index is None:
+        stored = _metadata().get(key)
+        if stored is not None:
+            index = AssignmentIndex.from_json(stored)
+            _indexes()[key] = index
+    if index is not None and time.time() - index.fetched_at > ASSIGNMENTS_TTL:
+        return None
+    return index
+
+
+async def refresh_assignment_index(client: MoodleClient) -> AssignmentIndex:
+    """Fetches all assignments of the user's enrolled courses in one call."""
+    key = _cache_key(client, "assignments")
+
+    async def fetch() -> AssignmentIndex:
+        data = await client.call("mod_assign_get_assignments")
+        index = AssignmentIndex.from_response(data if isinstance(data, dict) else {})
+        _indexes()[key] = index
+        _metadata().set(key, index.to_json(), ttl=ASSIGNMENTS_TTL)
+        _persist_metadata()
+        logger.info(f"Assignment index refreshed: {len(index)} assignments.")
+        return index
+
+    # Concurrent refreshes share one request
+    return await _flights.do(key, fetch)
+
+
+def _warm_assignment_index(client: MoodleClient):
+    # The task outlives the request, hold the tenant so its client isn't closed under it
+    tenant = tenants.current()
+    if tenant is not None:
+        tenant.hold()
+
+    async def warm():
+        try:
+            await refresh_assignment_index(client)
+        except Exception as e:
+            logger.warning(f"Background assignment index refresh failed: {e}")
+        finally:
+            if tenant is not None:
+                await tenant.release()
+    task = asyncio.create_task(warm())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def resolve_assignment(client: MoodleClient, assignment_id: str) -> Optional[dict]:
+    """
+    Looks up an assignment by cmid or instance id.
+    Served from the index, refreshed lazily when the ID is unknown.
+    """
+    await _load_metadata()
+    index = cached_assignment_index(client)
+    entry = index.resolve(assignment_id) if index else None
+    if entry is None and (index is None or time.time() - index.fetched_at > ASSIGNMENTS_MISS_REFRESH):
+        index = await refresh_assignment_index(client)
+        entry = index.resolve(assignment_id)
+    return entry
+
+
+# --- FILE INDEX ---
+# Extra folders searched alongside LAB_DIRECTORY (separated by os.pathsep, ';' on Windows)
+LAB_EXTRA_DIRS = [d for d in os.getenv("LAB_EXTRA_DIRS", "").split(os.pathsep) if d.strip()]
+FILE_INDEX_DB = os.getenv(
+    "FILE_INDEX_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".smartsubmit_files.db"),
+)
+# A folder is re-checked at most this often (seconds). Stat-only walk, cheap but not free.
+FILE_INDEX_REFRESH_SECONDS = float(os.getenv("FILE_INDEX_REFRESH_SECONDS", 10))
+# A search waits this long (seconds) for a slow folder scan, then answers from what is indexed
+FILE_SCAN_TIMEOUT = float(os.getenv("FILE_SCAN_TIMEOUT", 20))
+
+# Ranked results returned for a file search unless the caller asks for more
+DEFAULT_FILE_RESULTS = 20
+
+# SHA-1 of local files keyed by (path, size, mtime_ns), used to skip identical re-uploads
+_hash_cache: TTLCache = state.keep("tools.hash_cache", lambda: TTLCache(max_size=256, default_ttl=24 * 3600))
+
+
+def invalidate_metadata(name: Optional[str] = None):
+    """
+    Invalidation hook for the metadata cache.
+    name=None drops everything, otherwise 'site_info', 'courses' or 'assignments' for the current token.
+    The in-memory assignment indexes go too, they would otherwise keep answering from the old data.
+    """
+    if name is None:
+        _metadata().invalidate()
+        _indexes().clear()
+        logger.info("Metadata cache cleared.")
+    else:
+        prefix = _cache_key(get_client(), name)
+        _metadata().invalidate_prefix(prefix)
+        indexes = _indexes()
+        for key in [k for k in indexes if k.startswith(prefix)]:
+            del indexes[key]
+    _persist_metadata()
+
+def get_file_index() -> FileIndex:
+    """Process-wide on-disk file catalog, opened on first use."""
+    index = state.get("tools.file_index")
+    if index is None:
+        index = state.put("tools.file_index", FileIndex(FILE_INDEX_DB))
+    return index
+
+
+def get_file_catalog(roots: List[str]) -> Tuple[SearchIndex, Dict[str, tuple]]:
+    """
+    Ranked filename index plus {path: (path, name, size, mtime)} for these roots.
+    Rebuilt only when the file index changed.
+    """
+    index = get_file_index()
+    key = (tuple(sorted(os.path.abspath(r) for r in roots)), index.generation)
+    cached = state.get("tools.search_index")  # ((roots, generation), SearchIndex, rows by path)
+    if cached is None or cached[0] != key:
+        rows = {row[0]: row for row in index.files(roots)}
+        entries = [(path, name, mtime) for path, name, _, mtime in rows.values()]
+        cached = state.put("tools.search_index", (key, SearchIndex(entries), rows))
+        logger.info(f"Built search index over {len(entries)} files.")
+    return cached[1], cached[2]
+
+
+# File listings: 'score' (best match, needs a query), 'mtime' (newest first) or 'name' (by path)
+FILE_SORTS = ("score", "mtime", "name")
+
+
+async def list_lab_files(
+    directory: Union[str, List[str]],
+    search_query: str = None,
+    limit: int = DEFAULT_FILE_RESULTS,
+    sort: str = None,
+    cursor: str = None,
+    format: str = "text",
+) -> str:
+    """
+    Lists available PDF/Word reports under one or more directories (recursive). Optional filter.
+    Answers from the persistent file index, only changed folders are re-read from disk.
+    With a search_query, returns the best matches ranked by relevance and recency.
+    Results come in pages of `limit`, the returned cursor fetches the next page from cache.
+    sort: 'score' (default with a query), 'mtime' (newest first) or 'name' (default without).
+    format: 'text' (one full path per line) or 'json' (compact, with size/mtime/score).
+    """
+    if format not in results.FORMATS:
+        return f"Error: format must be one of {', '.join(results.FORMATS)}."
+    if limit is not None and limit < 0:
+        return "Error: limit must be 0 or more."
+    if cursor:
+        try:
+            return results.next_page("files", cursor, limit).render(format)
+        except results.CursorError as e:
+            return f"Error: {e}"
+    sort = sort or ("score" if search_query else "name")
+    if sort not in FILE_SORTS or (sort == "score" and not search_query):
+        return f"Error: sort must be one of {', '.join(FILE_SORTS)} ('score' needs a search query)."
+
+    roots = [directory] if isinstance(directory, str) else list(directory)
+    logger.info(f"Scanning directories: {roots} for query: {search_query}")
+    try:
+        # All disk access runs on the fs pool, a slow share must not block the event loop
+        found = await asyncio.gather(*(fs.exists(d) for d in roots), return_exceptions=True)
+        missing = [d for d, ok in zip(roots, found) if ok is not True]
+        roots = [d for d in roots if d not in missing]
+        if not roots:
+            logger.error(f"Directory not found: {missing}")
+            return f"Error: Directory '{missing[0]}' does not exist."
+
+        # Roots are refreshed in parallel. Slow ones are cut off and answered from the index as it is.
+        # Opening the SQLite catalog the first time touches the disk too
+        index = await fs.run(get_file_index)
+        refreshed = await asyncio.gather(
+            *(fs.run_cancellable(index.refresh, root, FILE_INDEX_REFRESH_SECONDS, timeout=FILE_SCAN_TIMEOUT)
+              for root in roots),
+            return_exceptions=True,
+        )
+        incomplete = [root for root, r in zip(roots, refreshed) if isinstance(r, BaseException)]
+        for root, r in zip(roots, refreshed):
+            if isinstance(r, BaseException):
+                logger.warning(f"Refreshing {root} did not finish: {r!r}")
+        notes = [f"(Note: still indexing {', '.join(incomplete)}, results may be incomplete)"] if incomplete else []
+
+        location = ", ".join(roots)
+        search_index, rows = await fs.run(get_file_catalog, roots, timeout=None)
         if search_query:
-            # "lab 1" -> ["lab", "1"] -> matches "Lab_Report_1.pdf"
-            tokens = search_query.lower().split()
-            files = [f for f in all_files if all(token in f.lower() for token in tokens)]
+            # Smart Matching: "lab 3" finds "LAB_03", "bda" finds "Big_Data_Analytics"
+            ranked, total = search_index.search(search_query, top_k=results.MAX_RESULTS)
+            logger.info(f"Found {total} matching files.")
+            items = [results.FileItem(*rows[path], score=score) for path, score in ranked]
+            if sort == "mtime":
+                items.sort(key=lambda f: -(f.mtime or 0))
+            elif sort == "name":
+                items.sort(key=lambda f: f.path)
+            title = "Found files (best match first)" if sort == "score" else "Found files"
+            empty = f"No files found matching '{search_query}' in {location}."
         else:
-            files = all_files
-
-        if not files:
-            if search_query:
-                return f"No files found matching '{search_query}' in {directory}."
-            logger.info("No report files found.")
-            return "No PDF or Word documents found in the specified directory."
-        
-        logger.info(f"Found {len(files)} files.")
-        # Return FULL PATHS so the agent can submit them directly
-        full_paths = [os.path.join(directory, f) for f in files]
-        return "Found files:\n" + "\n".join(full_paths)
+            total = len(rows)
+            logger.info(f"Found {total} files.")
+            # Only the pageable head of the listing is materialized
+            if sort == "mtime":
+                head = heapq.nlargest(results.MAX_RESULTS, rows.values(), key=lambda r: r[3] or 0)
+            else:
+                head = heapq.nsmallest(results.MAX_RESULTS, rows.values(), key=lambda r: r[0])
+            items = [results.FileItem(*row) for row in head]
+            title = "Found files"
+            empty = "No PDF or Word documents found in the specified directory."
+
+        if not items:
+            return results.Page("files", [], title, 0, notes=notes, empty=empty).render(format)
+        return results.paginate("files", items, title, limit, total=total, notes=notes).render(format)
     except Exception as e:
         logger.error(f"Error scanning directory: {str(e)}")
         return f"Error scanning directory: {str(e)}"
 
-async def check_deadlines(search_query: str = None) -> str:
+async def _load_course_map(client: MoodleClient) -> Dict[int, str]:
+    # 1. Get User ID (cached). A MoodleError here means the token itself is bad.
+    site_info = await get_site_info(client)
+    user_id = site_info["userid"]
+
+    # Step 1.5: Get User's Courses (Mapping ID -> Name, cached)
+    # We do this to show "Compiler Construction" instead of "61184"
+    try:
+        course_map = await get_course_map(client, user_id)
+        logger.info(f"Using {len(course_map)} courses for name mapping.")
+        return course_map
+    except Exception as e:
+        logger.warning(f"Failed to fetch course names (continuing with IDs): {e}")
+        return {}
+
+
+# Deadline listings can be ordered by due date (default), course or assignment name
+DEADLINE_SORTS = {
+    "due": lambda d: (d.due, d.name),
+    "course": lambda d: (d.course.lower(), d.due),
+    "name": lambda d: (d.name.lower(), d.due),
+}
+
+
+async def check_deadlines(
+    search_query: str = None,
+    limit: int = None,
+    fresh: bool = False,
+    sort: str = "due",
+    cursor: str = None,
+    format: str = "text",
+) -> str:
     """
     Fetches upcoming assignments from Moodle (NUST LMS).
     search_query: Optional string to filter assignments (e.g., 'Lab 1', 'CS101').
+    limit: Optional page size. Further pages are served from the cached result through `cursor`.
+    fresh: Skip the background-synced snapshot and ask the LMS directly.
+    sort: 'due' (default), 'course' or 'name'.
+    format: 'text' (readable list) or 'json' (compact, for programmatic use).
+    Identical concurrent queries (e.g. a burst of WhatsApp 'status' messages) share one LMS fetch.
     """
-    logger.info(f"Checking Moodle deadlines... Query: {search_query}")
-    if not MOODLE_TOKEN or not MOODLE_URL:
+    if format not in results.FORMATS:
+        return f"Error: format must be one of {', '.join(results.FORMATS)}."
+    if limit is not None and limit < 0:
+        return "Error: limit must be 0 or more."
+    if cursor:
+        try:
+            return results.next_page("deadlines", cursor, limit).render(format)
+        except results.CursorError as e:
+            return f"Error: {e}"
+    if sort not in DEADLINE_SORTS:
+        return f"Error: sort must be one of {', '.join(DEADLINE_SORTS)}."
+
+    logger.info(f"Checking Moodle deadlines... Query: {search_query} Limit: {limit} Fresh: {fresh} Sort: {sort}")
+    client = get_client()
+    if not client.configured:
         return "Error: MOODLE_TOKEN or MOODLE_URL not set in .env"
 
-    params = {
-        "wstoken": MOODLE_TOKEN,
-        "moodlewsrestformat": "json",
-        "wsfunction": "core_webservice_get_site_info"
-    }
-    
+    query_key = (search_query or "").strip().lower()
+    key = (_cache_key(client, "deadlines"), query_key, limit, fresh, sort)
+    page = await _flights.do(key, lambda: _fetch_deadlines(client, search_query, limit, fresh, sort))
+    return page if isinstance(page, str) else page.render(format)
+
+
+async def _fetch_deadlines(
+    client: MoodleClient, search_query: Optional[str], limit: Optional[int], fresh: bool, sort: str
+) -> Union[results.Page, str]:
+    # Answer from the deadline sync snapshot when it is recent enough
+    engine = deadline_sync.current_engine()
+    snapshot = engine.snapshot if engine is not None and engine.client is client else None
+    if not fresh and snapshot is not None and snapshot.age <= deadline_sync.DEADLINE_SNAPSHOT_MAX_AGE:
+        return await _deadline_page(client, _iterate(snapshot.upcoming()), search_query, limit, sort)
+
     try:
-        async with httpx.AsyncClient(timeout=30.0, verify=False) as client:
-            # 1. Get User ID
-            user_url = f"{MOODLE_URL}?wstoken={MOODLE_TOKEN}&moodlewsrestformat=json&wsfunction=core_webservice_get_site_info"
-            resp = await client.get(MOODLE_URL, params=params)
-            resp.raise_for_status()
-            site_info = resp.json()
-            
-            if "exception" in site_info:
-                return f"Moodle Error: {site_info.get('message')}"
-            
-            user_id = site_info["userid"]
-            
-            # Step 1.5: Get User's Courses (Mapping ID -> Name)
-            # We do this to show "Compiler Construction" instead of "61184"
-            course_map = {}
-            try:
-                courses_params = {
-                    "wstoken": MOODLE_TOKEN,
-                    "moodlewsrestformat": "json",
-                    "wsfunction": "core_enrol_get_users_courses",
-                    "userid": user_id
-                }
-                resp_courses = await client.get(MOODLE_URL, params=courses_params)
-                if resp_courses.status_code == 200:
-                    courses_data = resp_courses.json()
-                    if isinstance(courses_data, list):
-                        # Create map: {61184: "Compiler Construction", ...}
-                        course_map = {c.get("id"): c.get("fullname", "Unknown Course") for c in courses_data}
-                        logger.info(f"Fetched {len(course_map)} courses for name mapping.")
-            except Exception as e:
-                logger.warning(f"Failed to fetch course names (continuing with IDs): {e}")
-
-            # Step 2: Get Upcoming Action Events
-            # We use `timesortfrom` to get only FUTURE events.
-            import time
-            now_ts = int(time.time())
-            
-            params["wsfunction"] = "core_calendar_get_action_events_by_timesort"
-            params["timesortfrom"] = now_ts
-            # params["limitnum"] = 10 # Optional limit
-            
-            resp_events = await client.get(MOODLE_URL, params=params)
-            resp_events.raise_for_status()
-            events_data = resp_events.json()
-            
-            events = events_data.get("events", [])
-            
-            if not events:
-                return "No upcoming deadlines found (future only)."
-            
-            result = []
-            import re
-            
-            for e in events:
+        # Step 2: Get Upcoming Action Events
+        # We use `timesortfrom` to get only FUTURE events.
+        events = iter_action_events(client, int(time.time()))
+        return await _deadline_page(client, events, search_query, limit, sort, live=True)
+    except Exception as e:
+        # LMS slow or down: a somewhat stale snapshot beats an error. While the circuit breaker
+        # is open (LMS known to be down) any snapshot does, the note says how old it is.
+        outage = isinstance(e, CircuitOpenError)
+        if snapshot is not None and (outage or snapshot.age <= deadline_sync.DEADLINE_STALE_GRACE):
+            logger.warning(f"Live deadline fetch failed ({repr(e)}), serving snapshot from {snapshot.age:.0f}s ago.")
+            note = f"⚠️ LMS unreachable, showing deadlines synced {snapshot.age / 60:.0f} min ago."
+            return await _deadline_page(client, _iterate(snapshot.upcoming()), search_query, limit, sort, note=note)
+        if isinstance(e, MoodleError):
+            logger.error(f"Moodle Error: {e}")
+            return f"Moodle Error: {e.message}"
+        if outage:
+            logger.error(f"Error checking Moodle: {e}")
+            return f"Error checking Moodle: the LMS is not responding. Try again in {e.retry_after:.0f}s."
+        logger.error(f"Error checking Moodle: {repr(e)}")
+        return f"Error checking Moodle: {repr(e)}"
+
+
+async def _iterate(items: List[dict]) -> AsyncIterator[dict]:
+    for item in items:
+        yield item
+
+
+async def _deadline_page(
+    client: MoodleClient,
+    events: AsyncIterator[dict],
+    search_query: Optional[str],
+    limit: Optional[int],
+    sort: str,
+    live: bool = False,
+    note: Optional[str] = None,
+) -> results.Page:
+    """
+    Filters action events into the first page of a deadline listing.
+    The full list is collected and cached, so later pages come from the cache.
+    """
+    items, seen_any = await _collect_deadlines(client, events, search_query, prefetch_courses=live)
+    items.sort(key=DEADLINE_SORTS[sort])
+
+    title = "Upcoming Moodle Deadlines"
+    if search_query:
+        title += f" (filtering for '{search_query}')"
+    notes = [note] if note else []
+    if not items:
+        empty = "No upcoming deadlines found (future only)." if not seen_any else f"No deadlines found matching '{search_query}'."
+        return results.Page("deadlines", [], title, 0, notes=notes, empty=empty)
+    return results.paginate("deadlines", items, title, limit, notes=notes)
+
+
+async def _collect_deadlines(
+    client: MoodleClient,
+    events: AsyncIterator[dict],
+    search_query: Optional[str],
+    prefetch_courses: bool = False,
+) -> Tuple[List[results.DeadlineItem], bool]:
+    """Turns action events into DeadlineItems. Returns (items, whether any event was seen at all)."""
+    # Both IDs are shown when the assignment index is already warm (no extra request).
+    # Otherwise it is warmed in the background for the next call / submission.
+    await _load_metadata()
+    assignment_index = cached_assignment_index(client)
+    if assignment_index is None:
+        _warm_assignment_index(client)
+    # For live fetches, site info + course map run concurrently with the first events page.
+    # The map is only awaited if an event comes without its course name.
+    course_task = asyncio.create_task(_load_course_map(client)) if prefetch_courses else None
+    course_map = None
+    items: List[results.DeadlineItem] = []
+    seen_any = False
+    try:
+        try:
+            async for e in events:
+                seen_any = True
                 name = e.get("name", "Unknown Assignment")
-                course_info = e.get("course", {})
+                course_info = e.get("course") or {}
                 course_id = course_info.get("id", "??")
-                
+
                 # Try to get name from Event -> if fail, get from Map -> if fail, use ID
                 course_name = course_info.get("fullname")
-                if not course_name and course_id in course_map:
-                    course_name = course_map[course_id]
+                if not course_name:
+                    if course_map is None:
+                        if course_task is None:
+                            course_task = asyncio.create_task(_load_course_map(client))
+                        try:
+                            course_map = await course_task
+                        except Exception as ex:
+                            logger.warning(f"Course map lookup failed (continuing with IDs): {ex}")
+                            course_map = {}
+                    course_name = course_map.get(course_id)
                 if not course_name:
                     course_name = f"Course {course_id}"
-                
-                assign_id = str(e.get("instance", "N/A"))
-                time_str = e.get("formattedtime", "No date")
-                
+
                 # Filter by search_query if provided
                 full_text = f"{name} {course_name}".lower()
                 if search_query and search_query.lower() not in full_text:
@@ -144,171 +582,486 @@ async def check_deadlines(search_query: str = None) -> str:
 
                 # Clean cleaner output
                 # Remove HTML tags from name or description if any
-                clean_name = re.sub(r'<[^>]+>', '', name).strip()
-                result.append(f"- {clean_name} ({course_name}) [ID: {assign_id}]: Due {time_str}")
-            
-            if not result:
-                return f"No deadlines found matching '{search_query}'."
+                instance = e.get("instance")
+                items.append(results.DeadlineItem(
+                    name=re.sub(r'<[^>]+>', '', name).strip(),
+                    course=course_name,
+                    course_id=course_info.get("id"),
+                    assignment_id=instance,
+                    cmid=assignment_index.cmid_for_instance(instance) if assignment_index else None,
+                    due=e.get("timesort") or 0,
+                    due_text=e.get("formattedtime", "No date"),
+                ))
+        finally:
+            await events.aclose()
+        return items, seen_any
+    finally:
+        if course_task is not None:
+            if not course_task.done():
+                course_task.cancel()
+            elif not course_task.cancelled() and course_task.exception():
+                logger.warning(f"Course map lookup failed: {course_task.exception()}")
+
+async def file_sha1(file_path: str) -> str:
+    """SHA-1 of a local file, cached by (path, size, mtime) so repeat submissions don't re-read it."""
+    st = await fs.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+    digest = _hash_cache.get(key)
+    if digest is None:
+        def compute() -> str:
+            h = hashlib.sha1()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            return h.hexdigest()
+        # Hashing time grows with the file, no fixed timeout
+        digest = await fs.run(compute, timeout=None)
+        _hash_cache.set(key, digest)
+    return digest
+
+
+async def _remember_sha1(file_path: str, digest: str):
+    st = await fs.stat(file_path)
+    _hash_cache.set((os.path.abspath(file_path), st.st_size, st.st_mtime_ns), digest)
+
 
-            header = f"Upcoming Moodle Deadlines"
-            if search_query:
-                header += f" (filtering for '{search_query}')"
-            return f"{header}:\n" + "\n".join(result)
+def _submission_files(status_data: dict) -> List[dict]:
+    """Files attached to the last attempt, from mod_assign_get_submission_status."""
+    submission = (status_data.get("lastattempt") or {}).get("submission") or {}
+    files = []
+    for plugin in submission.get("plugins") or []:
+        if plugin.get("type") != "file":
+            continue
+        for area in plugin.get("fileareas") or []:
+            files.extend(area.get("files") or [])
+    return files
 
+
+async def _check_identical_submission(client: MoodleClient, assign_id: str, uploads: List["_Upload"]):
+    """
+    Returns (current_status, same_files). same_files is True when the submission holds exactly
+    these files with the same content. Sizes are compared first, the local files are only
+    hashed (and the remote ones fetched, if Moodle doesn't expose contenthash) when they match.
+    ZIPs built on the fly are never considered identical.
+    """
+    if any(u.entries is not None for u in uploads):
+        return "unknown", False
+    try:
+        status_data = await client.call("mod_assign_get_submission_status", assignid=assign_id)
     except Exception as e:
-        logger.error(f"Error checking Moodle: {repr(e)}")
-        return f"Error checking Moodle: {repr(e)}"
+        logger.warning(f"Pre-submission status check failed (uploading anyway): {e}")
+        return "unknown", False
+    if not isinstance(status_data, dict):
+        return "unknown", False
+
+    submission = (status_data.get("lastattempt") or {}).get("submission") or {}
+    status = submission.get("status", "unknown")
+    existing = _submission_files(status_data)
+    if len(existing) != len(uploads):
+        return status, False
+    # A single file is compared whatever its name, several are paired up by name
+    if len(uploads) == 1:
+        pairs = [(uploads[0], existing[0])]
+    else:
+        by_name = {f.get("filename"): f for f in existing}
+        pairs = [(u, by_name.get(u.name, {})) for u in uploads]
+    if any(remote.get("filesize") != u.size for u, remote in pairs):
+        return status, False
+
+    async def same_content(u: "_Upload", remote: dict) -> bool:
+        local_hash = await file_sha1(u.path)
+        remote_hash = remote.get("contenthash")
+        if not remote_hash and remote.get("fileurl"):
+            remote_hash = await client.download_sha1(remote["fileurl"])
+        return remote_hash == local_hash
+
+    try:
+        same = all(await asyncio.gather(*(same_content(u, remote) for u, remote in pairs)))
+    except Exception as e:
+        logger.warning(f"Could not compare with the existing submission: {e}")
+        return status, False
+
+    names = ", ".join(u.name for u in uploads)
+    logger.info(f"Existing submission {'matches' if same else 'differs from'} {names}")
+    return status, same
+
+
+@dataclass
+class _Upload:
+    """One file of a submission: a local file, or a ZIP streamed from `entries`."""
+    name: str
+    path: Optional[str] = None
+    entries: Optional[List[fs.ZipEntry]] = None
+    size: int = 0  # exact, for ZIPs too (fs.zip_size)
+
+
+def _zip_name(name: str) -> str:
+    return name if name.lower().endswith(".zip") else f"{name}.zip"
 
-async def submit_to_lms(assignment_id: str, file_path: str) -> str:
+
+async def _plan_uploads(file_paths: List[str], zip_as: Optional[str]) -> Union[List[_Upload], str]:
+    """
+    What goes into the draft area: plain files as they are, folders as streamed ZIPs,
+    everything in one ZIP named `zip_as` if given. Returns an error message if a path is unusable.
+    """
+    async def kind(path: str) -> Optional[str]:
+        if await fs.isdir(path):
+            return "dir"
+        return "file" if await fs.exists(path) else None
+
+    kinds = await asyncio.gather(*(kind(p) for p in file_paths), return_exceptions=True)
+    for path, k in zip(file_paths, kinds):
+        if isinstance(k, asyncio.TimeoutError):
+            return f"Error: Timed out accessing '{path}'. Is the drive or network share available?"
+        if isinstance(k, BaseException):
+            return f"Error: Could not access '{path}': {k}"
+        if k is None:
+            return f"Error: File '{path}' not found."
+
+    if zip_as:
+        groups = [(_zip_name(zip_as), file_paths)]
+    else:
+        groups = [(_zip_name(os.path.basename(os.path.normpath(p))), [p]) if k == "dir" else (None, p)
+                  for p, k in zip(file_paths, kinds)]
+
+    uploads = []
+    for name, paths in groups:
+        if name is None:
+            uploads.append(_Upload(os.path.basename(paths), path=paths, size=await fs.getsize(paths)))
+            continue
+        # Walking a big folder takes a while, no fixed timeout
+        entries = await fs.run(fs.zip_entries, paths, timeout=None)
+        if not entries:
+            return f"Error: Nothing to zip in {', '.join(paths)}."
+        uploads.append(_Upload(name, entries=entries, size=fs.zip_size(entries)))
+
+    names = [u.name for u in uploads]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        return f"Error: Two files would be uploaded as {', '.join(duplicates)}. Rename one or use zip_as."
+    return uploads
+
+
+class _CombinedProgress:
+    """Adds up the progress of concurrent uploads into one (sent, total, bytes/s) report."""
+
+    def __init__(self, callback: ProgressCallback, uploads: List[_Upload]):
+        self.callback = callback
+        self.sent = [0] * len(uploads)
+        self.total = sum(u.size for u in uploads)
+        self.started = time.monotonic()
+
+    def part(self, i: int) -> ProgressCallback:
+        async def report(sent: int, total: int, rate: float):
+            self.sent[i] = sent
+            done = sum(self.sent)
+            result = self.callback(done, self.total, done / max(time.monotonic() - self.started, 1e-6))
+            if inspect.isawaitable(result):
+                await result
+        return report
+
+
+async def _upload_files(
+    client: MoodleClient, uploads: List[_Upload], progress: Optional[ProgressCallback]
+) -> Union[int, str]:
+    """
+    Uploads every file into one draft area: the first creates it (itemid 0),
+    the others then go up concurrently into the same itemid.
+    Returns the draft itemid, or an error message.
+    """
+    combined = _CombinedProgress(progress, uploads) if progress and len(uploads) > 1 else None
+
+    async def upload(i: int, u: _Upload, itemid: int) -> Union[int, str]:
+        report = combined.part(i) if combined else progress
+        try:
+            if u.entries is None:
+                uploaded = await client.upload(u.path, itemid=itemid, progress=report)
+                await _remember_sha1(u.path, uploaded.sha1)
+            else:
+                chunks = fs.zip_stream(u.entries, UPLOAD_CHUNK_SIZE)
+                uploaded = await client.upload_stream(u.name, chunks, u.size, itemid=itemid, progress=report)
+                logger.info(f"Streamed {u.name} ({len(u.entries)} files zipped on the fly)")
+            upload_data = uploaded.response
+        except MoodleError as e:
+            upload_data = e.payload
+        except asyncio.TimeoutError:
+            size_mb = u.size / (1024 * 1024)
+            logger.error(f"Upload of {u.name} timed out ({size_mb:.1f} MB)")
+            return f"Error: Upload of {u.name} ({size_mb:.1f} MB) timed out. Check your connection and try again."
+        if not upload_data or not isinstance(upload_data, list) or 'itemid' not in upload_data[0]:
+            logger.error(f"Upload of {u.name} failed. Response: {upload_data}")
+            return f"Error: File upload failed. Server responded: {upload_data}"
+        return upload_data[0]['itemid']
+
+    draft_item_id = await upload(0, uploads[0], 0)
+    if isinstance(draft_item_id, str) or len(uploads) == 1:
+        return draft_item_id
+    rest = await asyncio.gather(
+        *(upload(i, u, draft_item_id) for i, u in enumerate(uploads[1:], 1)), return_exceptions=True
+    )
+    for r in rest:
+        if isinstance(r, BaseException):
+            raise r
+        if isinstance(r, str):
+            return r
+    return draft_item_id
+
+
+async def submit_to_lms(
+    assignment_id: str, file_path: str, progress: Optional[ProgressCallback] = None
+) -> str:
     """
     Submits a file to Moodle assignment using the full workflows:
-    1. Upload file to Draft Area (upload.php)
+    1. Upload file to Draft Area (upload.php), streamed with optional progress(sent, total, bytes/s)
     2. Save Submission (mod_assign_save_submission)
     3. Accept Statement & Finalize (mod_assign_submit_for_grading)
     """
+    result = await submit_assignment_file(assignment_id, file_path, progress)
+    return result.message
+
+
+async def submit_files_to_lms(
+    assignment_id: str,
+    file_paths: List[str],
+    zip_as: Optional[str] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> str:
+    """
+    Submits several files (e.g. report + code) to one assignment in a single workflow:
+    all of them are uploaded into one draft area, then saved and finalized once.
+    Folders are zipped on the fly, zip_as='Lab3' packs everything into one Lab3.zip
+    for assignments that only accept a single file.
+    """
+    result = await submit_assignment_files(assignment_id, file_paths, progress, zip_as)
+    return result.message
+
+
+SUBMIT_STEP_SECONDS = metrics.histogram(
+    "smartsubmit_submit_step_seconds", "Duration of each submit_to_lms step.", ["step"]
+)
+SUBMISSIONS = metrics.counter("smartsubmit_submissions_total", "Submission workflows by final status.", ["status"])
+
+
+async def submit_assignment_file(
+    assignment_id: str, file_path: str, progress: Optional[ProgressCallback] = None
+) -> SubmissionResult:
+    """Runs the submission workflow of submit_to_lms and returns a structured result."""
+    return await submit_assignment_files(assignment_id, [file_path], progress)
+
+
+async def submit_assignment_files(
+    assignment_id: str,
+    file_paths: List[str],
+    progress: Optional[ProgressCallback] = None,
+    zip_as: Optional[str] = None,
+) -> SubmissionResult:
+    """Runs the submission workflow for one or more files and returns a structured result."""
+    file_path = ", ".join(file_paths)
     logger.info(f"Starting submission process for {file_path} to Assignment {assignment_id}")
-    
-    if not os.path.exists(file_path):
-        return f"Error: File '{file_path}' not found."
-    
-    if not MOODLE_TOKEN or not MOODLE_URL:
-        return "Error: MOODLE_TOKEN or MOODLE_URL not set."
-
-    # Derive upload URL from MOODLE_URL (replace rest/server.php with upload.php)
-    # Env: https://lms.nust.edu.pk/webservice/rest/server.php
-    # Target: https://lms.nust.edu.pk/webservice/upload.php
-    upload_url = MOODLE_URL.replace("/rest/server.php", "/upload.php")
-    
+    started = time.monotonic()
+    real_assign_id = assignment_id
+    steps = metrics.StepTimer(SUBMIT_STEP_SECONDS)
+
+    def done(status: str, message: str) -> SubmissionResult:
+        steps.finish()
+        SUBMISSIONS.inc(status=status)
+        return SubmissionResult(
+            assignment_id=str(assignment_id),
+            file_path=file_path,
+            status=status,
+            message=message,
+            instance_id=str(real_assign_id),
+            elapsed=round(time.monotonic() - started, 3),
+        )
+
+    if not file_paths:
+        return done("error", "Error: No files given.")
+    uploads = await _plan_uploads(file_paths, zip_as)
+    if isinstance(uploads, str):
+        return done("error", uploads)
+
+    client = get_client()
+    if not client.configured:
+        return done("error", "Error: MOODLE_TOKEN or MOODLE_URL not set.")
+
     try:
-        async with httpx.AsyncClient(timeout=60.0, verify=False) as client:
-            
-            # --- STEP 0: RESOLVE ID (CMID -> INSTANCE ID) ---
-            # The user (or check_deadlines) often provides the "Course Module ID" (e.g. 1289553).
-            # But 'mod_assign_save_submission' demands the "Assignment Instance ID" (e.g. 505).
-            # We try to convert it.
-            real_assign_id = assignment_id
-            try:
-                # Attempt to treat input as CMID
-                cm_params = {
-                    "wstoken": MOODLE_TOKEN,
-                    "moodlewsrestformat": "json",
-                    "wsfunction": "core_course_get_course_module",
-                    "cmid": assignment_id
-                }
-                resp_cm = await client.get(MOODLE_URL, params=cm_params)
-                if resp_cm.status_code == 200:
-                    cm_data = resp_cm.json()
-                    # Response: { "cm": { "instance": 505, "modname": "assign", ... } } (structure varies)
-                    # Or sometimes directly the object? NUST formatting check needed.
-                    # Standard Moodle returns { "warnings": [], "cm": { ... } } or just the CM object?
-                    # Let's handle generic success.
-                    # Actually standard is: { "cm": { "id": 1289553, "course": 99, "module": 1, "name": "Lab 3", "modname": "assign", "instance": 4552, ... } }
-                    if isinstance(cm_data, dict) and "cm" in cm_data:
-                        found_instance = cm_data["cm"].get("instance")
-                        modname = cm_data["cm"].get("modname")
-                        if modname == "assign" and found_instance:
-                            real_assign_id = str(found_instance)
-                            logger.info(f"Resolved CMID {assignment_id} -> Assignment Instance ID {real_assign_id}")
-            except Exception as e:
-                logger.warning(f"ID Resolution failed (using {assignment_id} as is): {e}")
 
+        # --- STEP 0: RESOLVE ID (CMID -> INSTANCE ID) ---
+        steps.step("0_resolve")
+        # The user (or check_deadlines) often provides the "Course Module ID" (e.g. 1289553).
+        # But 'mod_assign_save_submission' demands the "Assignment Instance ID" (e.g. 505).
+        # The assignment index answers this locally, the LMS is only asked on a miss.
+        try:
+            entry = await resolve_assignment(client, assignment_id)
+            if entry:
+                real_assign_id = str(entry["id"])
+                if real_assign_id != str(assignment_id):
+                    logger.info(f"Resolved CMID {assignment_id} -> Assignment Instance ID {real_assign_id}")
+            else:
+                # Not in the user's assignment list, last resort: treat input as CMID
+                # Standard Moodle returns: { "cm": { "id": 1289553, "course": 99, "modname": "assign", "instance": 4552, ... } }
+                cm_data = await client.call("core_course_get_course_module", cmid=assignment_id)
+                if isinstance(cm_data, dict) and "cm" in cm_data:
+                    found_instance = cm_data["cm"].get("instance")
+                    modname = cm_data["cm"].get("modname")
+                    if modname == "assign" and found_instance:
+                        real_assign_id = str(found_instance)
+                        logger.info(f"Resolved CMID {assignment_id} -> Assignment Instance ID {real_assign_id}")
+        except Exception as e:
+            logger.warning(f"ID Resolution failed (using {assignment_id} as is): {e}")
+
+        # --- STEP 0.5: SKIP IDENTICAL RE-SUBMISSIONS ---
+        steps.step("0.5_dedup")
+        # Retries and repeat requests often send the exact same file again.
+        # If the submission already holds exactly this file (same SHA-1), skip the upload.
+        current_status, same_file = await _check_identical_submission(client, real_assign_id, uploads)
+        names = ", ".join(u.name for u in uploads)
+        if same_file and current_status == "submitted":
+            logger.info(f"Assignment {real_assign_id} already has this exact file submitted. Skipping.")
+            what = "this exact file" if len(uploads) == 1 else "these exact files"
+            return done("already_submitted",
+                        f"ALREADY SUBMITTED: Assignment {real_assign_id} already contains {what} "
+                        f"({names}) and is marked as SUBMITTED. Nothing was re-uploaded. ✅")
+
+        if same_file:
+            # Same file sits in a draft: only the finalize step is missing
+            logger.info("Identical file already saved as draft. Skipping upload and save.")
+        else:
             # --- STEP 1: UPLOAD FILE TO DRAFT AREA ---
-            logger.info("Step 1: Uploading file to Draft Area...")
-            with open(file_path, 'rb') as f:
-                files = {'file': (os.path.basename(file_path), f)}
-                # Moodle upload params
-                upload_params = {
-                    'token': MOODLE_TOKEN,
-                    'itemid': 0, # 0 = create new draft area
-                    'filearea': 'draft'
-                }
-                resp_upload = await client.post(upload_url, params=upload_params, files=files)
-                resp_upload.raise_for_status()
-                
-                # Response is a JSON list
-                upload_data = resp_upload.json()
-                if not upload_data or 'itemid' not in upload_data[0]:
-                    logger.error(f"Upload failed. Response: {upload_data}")
-                    return f"Error: File upload failed. Server responded: {upload_data}"
-                
-                draft_item_id = upload_data[0]['itemid']
-                logger.info(f"File uploaded successfully. Draft Item ID: {draft_item_id}")
+            logger.info(f"Step 1: Uploading {len(uploads)} file(s) to Draft Area...")
+            steps.step("1_upload")
+            # All files share one draft area, so save and finalize below run once for all of them
+            draft_item_id = await _upload_files(client, uploads, progress)
+            if isinstance(draft_item_id, str):
+                return done("error", draft_item_id)
+            logger.info(f"Uploaded {names}. Draft Item ID: {draft_item_id}")
 
             # --- STEP 2: SAVE SUBMISSION (DRAFT) ---
             logger.info("Step 2: Saving submission to assignment...")
+            steps.step("2_save")
             # We must pass the draft_item_id to the 'files_filemanager' plugin
-            save_params = {
-                "wstoken": MOODLE_TOKEN,
-                "moodlewsrestformat": "json",
-                "wsfunction": "mod_assign_save_submission",
-                "assignmentid": real_assign_id,
-                "plugindata[onlinetext_editor][text]": "",
-                "plugindata[onlinetext_editor][format]": 1,
-                "plugindata[onlinetext_editor][itemid]": 0,
-                "plugindata[files_filemanager]": draft_item_id
-            }
-            
-            resp_save = await client.post(MOODLE_URL, params=save_params)
-            resp_save.raise_for_status()
-            save_data = resp_save.json()
-            
-            # Moodle often returns null/empty list on success for this function, 
+            # Moodle often returns null/empty list on success for this function,
             # Or warnings list. If 'exception' key exists, it failed.
-            if isinstance(save_data, dict) and "exception" in save_data:
-                logger.error(f"Save Submission failed: {save_data}")
-                return f"Error Saving Draft: {save_data.get('message')} (Translated ID: {real_assign_id})"
-            
+            try:
+                await client.call(
+                    "mod_assign_save_submission",
+                    assignmentid=real_assign_id,
+                    **{
+                        "plugindata[onlinetext_editor][text]": "",
+                        "plugindata[onlinetext_editor][format]": 1,
+                        "plugindata[onlinetext_editor][itemid]": 0,
+                        "plugindata[files_filemanager]": draft_item_id,
+                    },
+                )
+            except MoodleError as e:
+                logger.error(f"Save Submission failed: {e.payload}")
+                return done("error", f"Error Saving Draft: {e.message} (Translated ID: {real_assign_id})")
+
             logger.info("Draft saved successfully.")
 
-            # --- STEP 3: SUBMIT FOR GRADING (Optional/Conditional) ---
-            logger.info("Step 3: Finalizing submission (Accepting Statement)...")
-            final_params = {
-                "wstoken": MOODLE_TOKEN,
-                "moodlewsrestformat": "json",
-                "wsfunction": "mod_assign_submit_for_grading",
-                "assignmentid": real_assign_id,
-                "acceptsubmissionstatement": 1
-            }
-            
-            resp_final = await client.post(MOODLE_URL, params=final_params)
-            resp_final.raise_for_status()
-            final_data = resp_final.json()
-            
-            # Logic: If Step 3 fails, it usually means the assignment doesn't REQUIRE explicit finalization 
+        # --- STEP 3: SUBMIT FOR GRADING (Optional/Conditional) ---
+        logger.info("Step 3: Finalizing submission (Accepting Statement)...")
+        steps.step("3_finalize")
+        try:
+            await client.call(
+                "mod_assign_submit_for_grading",
+                assignmentid=real_assign_id,
+                acceptsubmissionstatement=1,
+            )
+        except MoodleError as e:
+            # Logic: If Step 3 fails, it usually means the assignment doesn't REQUIRE explicit finalization
             # (it uses "Direct Submission" mode) OR it is a Re-submission where draft is enough.
-            if isinstance(final_data, dict) and "exception" in final_data:
-                msg = final_data.get('message', '')
-                logger.info(f"Auto-finalize skipped/failed: {msg}")
-            
-            # --- STEP 4: VERIFY SUBMISSION STATUS ---
-            # We don't trust the previous steps blindly. Check the actual status.
-            logger.info("Step 4: Verifying submission status...")
-            status_params = {
-                "wstoken": MOODLE_TOKEN,
-                "moodlewsrestformat": "json",
-                "wsfunction": "mod_assign_get_submission_status",
-                "assignid": real_assign_id
-            }
-            resp_status = await client.get(MOODLE_URL, params=status_params)
-            if resp_status.status_code == 200:
-                status_data = resp_status.json()
-                # Check 'lastattempt' -> 'submission' -> 'status'
-                # usually: { "lastattempt": { "submission": { "status": "submitted" } } }
-                last_attempt = status_data.get("lastattempt", {})
-                submission = last_attempt.get("submission", {})
-                status = submission.get("status", "unknown")
-                
-                logger.info(f"Final Submission Status: {status}")
-                
-                if status == "submitted":
-                     return f"SUCCESS: Assignment {real_assign_id} is marked as SUBMITTED. You are good to go! ✅"
-                elif status == "draft":
-                     return (f"PARTIAL SUCCESS: File uploaded to Assignment {real_assign_id}, but status is still 'DRAFT'.\n"
+            logger.info(f"Auto-finalize skipped/failed: {e.message}")
+
+        # --- STEP 4: VERIFY SUBMISSION STATUS ---
+        # We don't trust the previous steps blindly. Check the actual status.
+        logger.info("Step 4: Verifying submission status...")
+        steps.step("4_verify")
+        status = "unknown"
+        try:
+            status_data = await client.call("mod_assign_get_submission_status", assignid=real_assign_id)
+        except Exception as e:
+            logger.warning(f"Status check failed: {e}")
+            status_data = None
+        if isinstance(status_data, dict):
+            # Check 'lastattempt' -> 'submission' -> 'status'
+            # usually: { "lastattempt": { "submission": { "status": "submitted" } } }
+            last_attempt = status_data.get("lastattempt", {})
+            submission = last_attempt.get("submission", {})
+            status = submission.get("status", "unknown")
+
+            logger.info(f"Final Submission Status: {status}")
+
+            if status == "submitted":
+                 return done("submitted", f"SUCCESS: Assignment {real_assign_id} is marked as SUBMITTED. You are good to go! ✅")
+            elif status == "draft":
+                 return done("draft",
+                             f"PARTIAL SUCCESS: File uploaded to Assignment {real_assign_id}, but status is still 'DRAFT'.\n"
                              f"⚠️ You MUST log in to Moodle and click 'Submit Assignment' (and check the 'My Own Work' box) manually.\n"
                              f"The agent tried to do this but Moodle requires manual confirmation for this specific assignment.")
-            
-            return f"SUCCESS: File uploaded. Please verify on Moodle if the status is 'Submitted'. (Status code: {status})"
 
+        return done("uploaded", f"SUCCESS: File uploaded. Please verify on Moodle if the status is 'Submitted'. (Status code: {status})")
+
+    except CircuitOpenError as e:
+        logger.error(f"Submission stopped: {e}")
+        return done("error", f"Error: The LMS is not responding, the submission was not completed. "
+                             f"Try again in {e.retry_after:.0f}s.")
     except Exception as e:
         logger.error(f"Submission Error: {repr(e)}")
-        return f"Critical Error during submission process: {repr(e)}"
+        return done("error", f"Critical Error during submission process: {repr(e)}")
+
+
+async def submit_batch_to_lms(
+    items: List[Union[dict, tuple, list]], max_concurrency: int = BATCH_CONCURRENCY
+) -> List[SubmissionResult]:
+    """
+    Submits several (assignment, file) pairs concurrently, at most max_concurrency workflows at once.
+    items: [{"assignment_id": "1289553", "file_path": "C:/.../lab3.pdf"}, ...] or [(id, path), ...]
+    Workflows overlap, so one item uploads while another is saving or being verified.
+    Returns one SubmissionResult per item, in input order.
+    """
+    pairs = []
+    for item in items:
+        if isinstance(item, dict):
+            pairs.append((str(item.get("assignment_id", "")), str(item.get("file_path", ""))))
+        else:
+            assignment_id, file_path = item
+            pairs.append((str(assignment_id), str(file_path)))
+    logger.info(f"Starting batch submission of {len(pairs)} items (concurrency {max_concurrency})")
+    started = time.monotonic()
+
+    # Two files for one assignment would overwrite each other, only the first one goes through.
+    # CMIDs and instance IDs are normalized first so both spellings are caught.
+    client = get_client()
+    owners: Dict[str, int] = {}
+    duplicates: Dict[int, int] = {}
+    for i, (assignment_id, _) in enumerate(pairs):
+        key = assignment_id
+        try:
+            entry = await resolve_assignment(client, assignment_id)
+            if entry:
+                key = str(entry["id"])
+        except Exception:
+            pass
+        if key in owners:
+            duplicates[i] = owners[key]
+        else:
+            owners[key] = i
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(i: int, assignment_id: str, file_path: str) -> SubmissionResult:
+        if i in duplicates:
+            first = pairs[duplicates[i]][1]
+            return SubmissionResult(
+                assignment_id, file_path, "error",
+                f"Error: Assignment {assignment_id} appears more than once in this batch. "
+                f"Only '{os.path.basename(first)}' was submitted.",
+            )
+        async with semaphore:
+            return await submit_assignment_file(assignment_id, file_path)
+
+    outcomes = await asyncio.gather(*(run(i, a, f) for i, (a, f) in enumerate(pairs)))
+    ok = sum(1 for r in outcomes if r.ok)
+    logger.info(f"Batch finished: {ok}/{len(outcomes)} succeeded in {time.monotonic() - started:.1f}s")
+    return list(outcomes)
@@ -1,13 +1,45 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import Response
+from fastapi.responses import PlainTextResponse, Response
 from tools import check_deadlines, submit_to_lms, list_lab_files
+from moodle_client import close_client
+from jobs import JobQueue, make_sender
+from deadline_sync import start_engine, stop_engine
+from cache import SingleFlight, TTLCache
+from tenants import Tenant, get_registry, close_registry
+import metrics
+import fs
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+# Slow LMS work (deadlines, submissions) runs here so Twilio gets its answer immediately.
+# Stays None without an outbound sender (Twilio not fully configured): commands then run inline.
+# Tests can swap the outbound sender: job_queue.sender = LogSender()
+job_queue: JobQueue = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_queue
+    if job_queue is None:
+        sender = make_sender()
+        if sender is not None:
+            job_queue = JobQueue(sender)
+    if job_queue is not None:
+        await job_queue.start()
+    await start_engine()
+    yield
+    await stop_engine()
+    if job_queue is not None:
+        await job_queue.stop()
+    # Release the shared and per-tenant Moodle connection pools on shutdown
+    await close_registry()
+    await close_client()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure logging
 logging.basicConfig(
@@ -18,19 +50,119 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 ALLOWED_NUMBER = os.getenv("WHATSAPP_ALLOWED_NUMBER")
+# "submit <id> <folder>" zips and uploads a whole folder of the lab directory, off unless enabled
+ALLOW_FOLDER_SUBMIT = os.getenv("WHATSAPP_ALLOW_FOLDER_SUBMIT", "0") == "1"
+
+# Twilio retries a webhook it considers slow. Replies are remembered per MessageSid
+# and replayed, so a retry never runs a command (e.g. a submission) twice.
+MESSAGE_DEDUP_TTL = float(os.getenv("MESSAGE_DEDUP_TTL", 3600))
+_replies = TTLCache(max_size=2048, default_ttl=MESSAGE_DEDUP_TTL)
+# A retry arriving while the original is still being handled waits for its reply
+_message_flights = SingleFlight()
+
+NO_LAB_DIRECTORY_REPLY = "No lab folder is configured for your number, so files can't be listed or submitted."
+WORKING_REPLY = "⏳ Working on it... I'll message you the result in a moment."
+BUSY_REPLY = "I'm busy with other requests right now. Please try again in a minute."
+
+def twiml_reply(text: str, final: bool = True) -> Response:
+    # Twilio expects XML response, but for simple messaging we can just return plain text 
+    # if we use the messaging_response wrapper, OR just return 200 OK and use the API to send a message back.
+    # The simplest way to reply is TwiML.
+    # final=False marks a "try again" reply: the message was not handled, so it is not replayed to retries.
+    from twilio.twiml.messaging_response import MessagingResponse
+    resp = MessagingResponse()
+    resp.message(text)
+    response = Response(content=str(resp), media_type="application/xml")
+    response.final = final
+    return response
+
+async def enqueue(to: str, description: str, run, tenant: Tenant = None) -> Response:
+    """
+    Hands a slow command to the worker pool and answers Twilio right away. It runs as `tenant`,
+    which is held from now on so it can't be evicted while the job waits in the queue.
+    Without a job queue (no outbound sender) the command runs now and its result is the reply.
+    """
+    if job_queue is None:
+        try:
+            text = await get_registry().run(tenant, run)
+        except Exception as e:
+            logger.error(f"'{description}' failed: {repr(e)}")
+            text = f"Sorry, '{description}' failed: {repr(e)}"
+        return twiml_reply(text)
+    if tenant is not None:
+        tenant.hold()
+    job = lambda: get_registry().run(tenant, run, held=True)
+    if not job_queue.submit(to, description, job):
+        if tenant is not None:
+            await tenant.release()
+        return twiml_reply(BUSY_REPLY, final=False)
+    return twiml_reply(WORKING_REPLY)
 
 @app.post("/whatsapp")
 async def whatsapp_webhook(
     From: str = Form(...),
-    Body: str = Form(...)
+    Body: str = Form(...),
+    MessageSid: str = Form(None)
 ):
     """
     Handle incoming WhatsApp messages from Twilio.
+    Idempotent per MessageSid: retries get the original reply back.
+    """
+    if not MessageSid:
+        return await handle_message(From, Body)
+
+    cached = _replies.get(MessageSid)
+    if cached is not None:
+        logger.info(f"Duplicate delivery of {MessageSid}, replaying reply.")
+        return Response(content=cached[0], status_code=cached[1], media_type=cached[2])
+
+    async def handle() -> Response:
+        response = await handle_message(From, Body)
+        # Only replies to handled messages are replayed, a retry after "busy" gets another chance
+        if getattr(response, "final", True):
+            _replies.set(MessageSid, (response.body.decode("utf-8"), response.status_code, response.media_type))
+        return response
+
+    return await _message_flights.do(MessageSid, handle)
+
+async def lab_directory(tenant: Tenant = None) -> str:
+    """
+    The tenant's configured lab directory (None if it has none: tenants never share a folder),
+    in single-user mode ~/Documents/University (or the CWD if missing).
+    """
+    if tenant is not None:
+        return tenant.lab_directory
+    default_dir = os.path.join(os.path.expanduser("~"), "Documents", "University")
+    if not await fs.exists(default_dir):
+        default_dir = os.getcwd()
+    return default_dir
+
+def confine_path(base: str, filename: str) -> str:
+    """
+    filename resolved inside base, following '..' and symlinks. None if it ends up outside,
+    e.g. an absolute path or '../otherstudent'. Blocking, call it through fs.run().
     """
+    root = os.path.realpath(base)
+    path = os.path.realpath(os.path.join(root, filename))
+    try:
+        inside = os.path.commonpath([root, path]) == root
+    except ValueError:  # Different drives on Windows
+        inside = False
+    return path if inside and path != root else None
+
+async def handle_message(From: str, Body: str) -> Response:
     logger.info(f"Received message from {From}: {Body}")
 
-    # Security Check
-    if ALLOWED_NUMBER and From != f"whatsapp:{ALLOWED_NUMBER}":
+    # Security Check: with a TENANTS_FILE every registered number uses its own Moodle account,
+    # otherwise only WHATSAPP_ALLOWED_NUMBER is served with the global MOODLE_TOKEN
+    tenant = None
+    registry = get_registry()
+    if registry.enabled:
+        tenant = await registry.resolve(From)
+        if tenant is None:
+            logger.warning(f"Unauthorized access attempt from {From}")
+            return Response(content="Unauthorized", status_code=403)
+    elif ALLOWED_NUMBER and From != f"whatsapp:{ALLOWED_NUMBER}":
         logger.warning(f"Unauthorized access attempt from {From}")
         return Response(content="Unauthorized", status_code=403)
 
@@ -43,7 +175,7 @@ async def whatsapp_webhook(
         query = command.replace("status", "").replace("deadline", "").strip()
         # If query is empty strings like "", treat as None
         query = query if query else None
-        response_text = await check_deadlines(query)
+        return await enqueue(From, f"deadlines {query or ''}".strip(), lambda: check_deadlines(query), tenant)
     
     elif "files" in command or "list" in command:
         # Default scan directory - in a real app, maybe configurable or derived from session
@@ -53,39 +185,45 @@ async def whatsapp_webhook(
         # Let's use the current working directory for simplicity if 'Documents/University' is theoretical.
         # But per requirements: "scans a specific local directory (e.g., ~/Documents/University)"
         # I'll default to that but fallback to CWD if it fails to be helpful.
-        default_dir = os.path.join(os.path.expanduser("~"), "Documents", "University")
-        if not os.path.exists(default_dir):
-            default_dir = os.getcwd()
-            
-        response_text = await list_lab_files(default_dir)
+        default_dir = await lab_directory(tenant)
+        if default_dir is None:
+            response_text = NO_LAB_DIRECTORY_REPLY
+        else:
+            response_text = await list_lab_files(default_dir, limit=0)
 
     elif "submit" in command:
         # Very basic parsing for demo: "submit <assignment_id> <filename>"
-        parts = command.split()
+        # Split the original body so the filename keeps its case
+        parts = Body.strip().split()
         if len(parts) >= 3:
             assignment_id = parts[1]
             filename = " ".join(parts[2:]) # Handle filenames with spaces?
-            # We need a full path. We'll search for it in our default dir.
-            default_dir = os.path.join(os.path.expanduser("~"), "Documents", "University")
-            if not os.path.exists(default_dir):
-                default_dir = os.getcwd()
-                
-            full_path = os.path.join(default_dir, filename)
-            response_text = await submit_to_lms(assignment_id, full_path)
+            # We need a full path. We'll search for it in our default dir, and only there:
+            # with several tenants, any other path could be someone else's file (or tenants.json).
+            default_dir = await lab_directory(tenant)
+            if default_dir is None:
+                return twiml_reply(NO_LAB_DIRECTORY_REPLY)
+            try:
+                full_path = await fs.run(confine_path, default_dir, filename)
+                is_folder = full_path is not None and await fs.isdir(full_path)
+            except asyncio.TimeoutError:
+                return twiml_reply("Your lab folder is not responding right now. Please try again later.", final=False)
+            if full_path is None:
+                logger.warning(f"Rejected submit of '{filename}' from {From}: outside {default_dir}")
+                return twiml_reply("You can only submit files from your own lab folder.")
+            if is_folder and not ALLOW_FOLDER_SUBMIT:
+                return twiml_reply(f"'{filename}' is a folder. Please send the name of a file.")
+            return await enqueue(From, f"submit {filename}", lambda: submit_to_lms(assignment_id, full_path), tenant)
         else:
             response_text = "Usage: submit <assignment_id> <filename>"
 
-    # Twilio expects XML response, but for simple messaging we can just return plain text 
-    # if we use the messaging_response wrapper, OR just return 200 OK and use the API to send a message back.
-    # The requirement says "FastAPI endpoint... receives Twilio webhooks".
-    # The simplest way to reply is TwiML.
-    
-    from twilio.twiml.messaging_response import MessagingResponse
-    resp = MessagingResponse()
-    resp.message(response_text)
-    
-    return Response(content=str(resp), media_type="application/xml")
+    return twiml_reply(response_text)
 
 @app.get("/")
 async def root():
     return {"status": "SmartSubmit WhatsApp Agent Running"}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape target: Moodle call latencies, submit step timings, errors, bytes uploaded."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")